@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Measure how long importing fluffy and listing the tasks of a fabfile that
+uses it takes, and fail if heavy optional dependencies are imported
+eagerly or the time exceeds the given budget.
+
+    python benchmarks/import_time.py --repeat 10 --max-ms 500
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['fluffy.prepare', 'fluffy.remote', 'fluffy.django',
+           'fluffy.search', 'fluffy.digital_ocean', 'fluffy.orchestrate',
+           'fluffy.static', 'fluffy.trace', 'fluffy.connections',
+           'fluffy.distribute', 'fluffy.schedule']
+
+# Dependencies that must only be imported when they are actually used
+LAZY_MODULES = ['jinja2', 'digitalocean', 'django']
+
+FABFILE = """
+from fluffy.prepare import *  # noqa
+from fluffy.remote import *  # noqa
+from fluffy.django import *  # noqa
+from fluffy.search import *  # noqa
+from fluffy.orchestrate import *  # noqa
+"""
+
+
+def _time(command, repeat):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call(command, env=env, stdout=open(os.devnull, 'w'))
+        timings.append(time.time() - start)
+    return sorted(timings)[len(timings) // 2] * 1000
+
+
+def check_lazy_modules():
+    code = ('import sys; import {}; print " ".join(m for m in {!r} '
+            'if m in sys.modules)'.format(', '.join(MODULES), LAZY_MODULES))
+    output = subprocess.check_output(
+        [sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=ROOT))
+    return output.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if the median import time exceeds this')
+    args = parser.parse_args()
+
+    failed = False
+    eager = check_lazy_modules()
+    if eager:
+        print 'Imported eagerly: {}'.format(', '.join(eager))
+        failed = True
+
+    baseline = _time([sys.executable, '-c', 'import fabric.api'],
+                     args.repeat)
+    imports = _time([sys.executable, '-c', 'import {}'.format(
+        ', '.join(MODULES))], args.repeat)
+
+    tmp_dir = tempfile.mkdtemp(prefix='fluffy-import-')
+    try:
+        fabfile = os.path.join(tmp_dir, 'fabfile.py')
+        with open(fabfile, 'w') as fh:
+            fh.write(FABFILE)
+        listing = _time(['fab', '-f', fabfile, '-l'], args.repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print 'import fabric.api   {:8.1f} ms'.format(baseline)
+    print 'import fluffy       {:8.1f} ms'.format(imports)
+    print 'fab -l              {:8.1f} ms'.format(listing)
+
+    if args.max_ms is not None and imports > args.max_ms:
+        print 'Importing fluffy exceeds {} ms'.format(args.max_ms)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
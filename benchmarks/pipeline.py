@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Benchmark the prepare -> upload -> unpack -> virtualenv -> switch_symlink
+pipeline against a synthetic repository using the local backend.
+
+    python benchmarks/pipeline.py --files 5000 --size 4096 --repeat 3
+
+All remote paths live in a scratch directory, so no servers are needed.
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fabric.api import env, settings, hide  # noqa
+
+from fluffy import trace  # noqa
+from fluffy.prepare import prepare  # noqa
+from fluffy.remote import (initialise_project, upload, unpack,  # noqa
+                           update_virtualenv, switch_symlink)
+
+STEPS = ['prepare', 'upload', 'unpack', 'update_virtualenv',
+         'switch_symlink']
+
+
+def create_repository(path, files, size, web_dir='web'):
+    """
+    Create a git repository in *path* with *files* files of *size* bytes
+    spread over nested directories below *web_dir*.
+    """
+    requirements = os.path.join(path, web_dir, 'deploy', 'requirements')
+    os.makedirs(requirements)
+    with open(os.path.join(requirements, 'bench.txt'), 'w') as fh:
+        fh.write('')
+
+    for idx in range(files):
+        directory = os.path.join(path, web_dir, 'app{}'.format(idx // 100),
+                                 'module{}'.format(idx // 10 % 10))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file{}.py'.format(idx)),
+                  'wb') as fh:
+            fh.write(os.urandom(size // 2).encode('hex')[:size])
+
+    git = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost']
+    subprocess.check_call(['git', 'init', '-q', path])
+    subprocess.check_call(git + ['add', '.'], cwd=path)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'Synthetic build'],
+                          cwd=path)
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=path).strip()
+
+
+def configure(root, version, web_dir='web'):
+    project_dir = os.path.join(root, 'project')
+    env.update({
+        'fluffy_backend': 'local',
+        'host_string': 'local',
+        'build': 'bench',
+        'user': 'bench',
+        'version': version,
+        'web_dir': web_dir,
+        'django_version': (1, 8),
+        'requires_tag': False,
+        'project_dir': project_dir,
+        'builds_dir': os.path.join(project_dir, 'builds'),
+        'virtualenv': os.path.join(project_dir, 'virtualenvs', 'bench'),
+        'code_dir': os.path.join(project_dir, 'builds', 'bench'),
+        'build_cache_dir': os.path.join(root, 'cache'),
+    })
+
+
+def run_pipeline(args, upload_dir, idx):
+    prepare(use_cache=args.cache, streaming=args.streaming,
+            compression=args.compression)
+    # Builds are named by the minute, keep repeated runs apart
+    env.build_dir = '{}-{}'.format(env.build_dir, idx)
+    env.code_dir = '{}-{}'.format(env.code_dir, idx)
+    remote_archive = os.path.join(upload_dir, os.path.basename(
+        env.build_file))
+    upload(env.build_file, remote_archive)
+    unpack(remote_archive, link_unchanged=args.link_unchanged)
+    if args.virtualenv:
+        update_virtualenv(use_wheels=False, update=False, options=['-q'])
+    switch_symlink()
+
+
+def summarise(events):
+    print '{:<20} {:>10} {:>10} {:>10} {:>12}'.format(
+        'step', 'min (s)', 'median (s)', 'commands', 'bytes')
+    for name in STEPS:
+        runs = [e for e in events if e['name'] == name]
+        if not runs:
+            continue
+        durations = sorted(e['duration'] for e in runs)
+        print '{:<20} {:>10.3f} {:>10.3f} {:>10} {:>12}'.format(
+            name, durations[0], durations[len(durations) // 2],
+            runs[-1]['commands'], runs[-1]['bytes'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=4096,
+                        help='size of each file in bytes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--compression', default='gz')
+    parser.add_argument('--cache', action='store_true',
+                        help='use the build artifact cache')
+    parser.add_argument('--link-unchanged', action='store_true')
+    parser.add_argument('--trace', help='write a Chrome trace to this file')
+    args = parser.parse_args()
+    args.virtualenv = bool(find_executable('virtualenv'))
+
+    root = tempfile.mkdtemp(prefix='fluffy-bench-')
+    cwd = os.getcwd()
+    try:
+        repository = os.path.join(root, 'repo')
+        configure(root, create_repository(repository, args.files, args.size))
+        os.chdir(repository)
+
+        with settings(hide('running', 'stdout')):
+            if args.virtualenv:
+                initialise_project()
+            else:
+                for name in ('builds/bench-0', 'media/bench'):
+                    os.makedirs(os.path.join(env.project_dir, name))
+                os.symlink('bench-0', os.path.join(env.builds_dir, 'bench'))
+
+            for idx in range(args.repeat):
+                run_pipeline(args, root, idx)
+
+        summarise(trace.get_events())
+        if args.trace:
+            os.chdir(cwd)
+            trace.write_chrome_trace(args.trace)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Keep one SSH transport per host alive for the whole deployment and reuse
+a single SFTP session per host for all uploads.
+
+Fabric already caches a client per host in ``fabric.state.connections``
+and multiplexes command channels over its transport. This module adds
+reconnecting when that transport went away while idle, keepalives and a
+per-host SFTP session so that uploads don't open a new one every time.
+"""
+from __future__ import absolute_import
+
+from fabric.api import env
+from fabric.sftp import SFTP
+from fabric.state import connections
+from fabric.network import normalize_to_string
+
+_sftp = {}
+_stats = {}
+
+
+class _PooledSFTP(SFTP):
+    """ Fabric's ``SFTP`` helper on an already open SFTP session """
+
+    def __init__(self, ftp):
+        self.ftp = ftp
+
+
+def _host_stats(key):
+    return _stats.setdefault(key, {
+        'connects': 0, 'reconnects': 0, 'sftp_opened': 0, 'sftp_reused': 0})
+
+
+def get_client():
+    """
+    Return the SSH client for the current host, connecting or reconnecting
+    if its transport is not active.
+    """
+    key = normalize_to_string(env.host_string)
+    stats = _host_stats(key)
+
+    if key in connections:
+        transport = connections[key].get_transport()
+        if transport is None or not transport.is_active():
+            stats['reconnects'] += 1
+            connections.connect(key)
+    else:
+        stats['connects'] += 1
+
+    client = connections[key]
+    transport = client.get_transport()
+    if not env.keepalive:
+        transport.set_keepalive(env.get('pool_keepalive', 30))
+    return client
+
+
+def get_sftp():
+    """
+    Return a Fabric ``SFTP`` helper for the current host, reusing the SFTP
+    session of previous uploads while its transport is still the current
+    one. Sessions left over from a parent process are never reused.
+    """
+    key = normalize_to_string(env.host_string)
+    stats = _host_stats(key)
+    transport = get_client().get_transport()
+
+    ftp = _sftp.get(key)
+    channel = ftp.get_channel() if ftp else None
+    if (channel is not None and not channel.closed and
+            channel.get_transport() is transport):
+        stats['sftp_reused'] += 1
+    else:
+        stats['sftp_opened'] += 1
+        ftp = _sftp[key] = transport.open_sftp_client()
+
+    return _PooledSFTP(ftp)
+
+
+def pool_stats():
+    """ Return connection and SFTP session counters per host """
+    return dict((key, dict(stats)) for key, stats in _stats.items())
+
+
+def close_all():
+    for ftp in _sftp.values():
+        ftp.close()
+    _sftp.clear()
@@ -1,23 +1,98 @@
 import os
 import re
+import sys
+import json
+import time
+import hashlib
 
 from fabric.api import env
 
-try:
-    from digitalocean import Manager
-except ImportError:
-    import sys
-    print ("You are trying to connct to digital ocean but "
-           "don't have python-digitalocean installed. Please install it.")
-    sys.exit(27)
 
+INVENTORY_CACHE_DIR = os.path.expanduser('~/.cache/fluffy')
 
-def get_roles(client_id=None, api_key=None, blacklist=None, ssh_port=22):
+
+def _get_manager(client_id, api_key):
+    try:
+        from digitalocean import Manager
+    except ImportError:
+        print ("You are trying to connct to digital ocean but "
+               "don't have python-digitalocean installed. Please install it.")
+        sys.exit(27)
+    return Manager(client_id=client_id, api_key=api_key)
+
+
+def _inventory_cache_path(client_id, tag=None):
+    key = hashlib.sha1('{}:{}'.format(client_id, tag or '')).hexdigest()
+    return os.path.join(INVENTORY_CACHE_DIR, 'droplets-{}.json'.format(key))
+
+
+def _get_region(droplet):
+    region = getattr(droplet, 'region', None)
+    if isinstance(region, dict):
+        return region.get('slug')
+    return region or getattr(droplet, 'region_id', None)
+
+
+def _fetch_inventory(manager, tag=None):
+    """
+    Retrieve all droplets from the DO API as a list of dictionaries. When
+    *tag* is given the droplets are filtered by the API (API v2 only).
+    """
+    if tag:
+        droplets = manager.get_all_droplets(tag_name=tag)
+    else:
+        droplets = manager.get_all_droplets()
+    return [{'name': droplet.name,
+             'ip_address': droplet.ip_address,
+             'region': _get_region(droplet)} for droplet in droplets]
+
+
+def _load_inventory(path, ttl):
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def _store_inventory(path, inventory):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        json.dump(inventory, fh)
+    os.rename(tmp_path, path)
+
+
+def invalidate_inventory_cache():
+    """ Remove all cached droplet inventories """
+    if not os.path.isdir(INVENTORY_CACHE_DIR):
+        return
+    for name in os.listdir(INVENTORY_CACHE_DIR):
+        if name.startswith('droplets-'):
+            os.remove(os.path.join(INVENTORY_CACHE_DIR, name))
+
+
+def get_roles(client_id=None, api_key=None, blacklist=None, ssh_port=22,
+              tag=None, region=None, cache_ttl=None, manager=None):
+    """
+    Build a dictionary of roles to host strings from the droplets in the
+    Digital Ocean account.
+
+    The droplet inventory is cached on disk for *cache_ttl* seconds
+    (``env.do_inventory_ttl``, 5 minutes by default); use ``0`` to always
+    query the API or :func:`invalidate_inventory_cache` to drop the cache.
+    Droplets can be limited to those with *tag* (filtered by the API) and
+    to those in *region*. A *manager* can be passed in instead of the
+    ``digitalocean.Manager`` created from the credentials.
+    """
     ip_blacklist = blacklist or []
     client_id = client_id or os.getenv("DO_CLIENT_ID")
     api_key = api_key or os.getenv("DO_API_KEY")
 
-    if not client_id or not api_key:
+    if manager is None and (not client_id or not api_key):
         print ("You have to provide the client ID and API key for Digital "
                "Ocean. Set DO_CLIENT_ID and DO_API_KEY environment variables.")
         sys.exit(28)
@@ -28,18 +103,32 @@ def get_roles(client_id=None, api_key=None, blacklist=None, ssh_port=22):
     if not env.server_format:
         env.server_format = "{ip}:{port}"
 
-    # Retrieve the app server IPs from the DO API
-    manager = Manager(client_id=client_id, api_key=api_key)
+    if cache_ttl is None:
+        cache_ttl = env.get('do_inventory_ttl', 300)
+
+    cache_path = _inventory_cache_path(client_id, tag)
+    inventory = _load_inventory(cache_path, cache_ttl) if cache_ttl else None
+
+    if inventory is None:
+        # Retrieve the app server IPs from the DO API
+        if manager is None:
+            manager = _get_manager(client_id, api_key)
+        inventory = _fetch_inventory(manager, tag=tag)
+        if cache_ttl:
+            _store_inventory(cache_path, inventory)
 
     roles = {}
-    for droplet in manager.get_all_droplets():
-        if droplet.ip_address in ip_blacklist:
+    for droplet in inventory:
+        if droplet['ip_address'] in ip_blacklist:
+            continue
+
+        if region and droplet['region'] != region:
             continue
 
-        match = env.server_name_regex.match(droplet.name)
+        match = env.server_name_regex.match(droplet['name'])
         if not match:
             continue
 
         roles.setdefault(match.group('role'), []).append(
-            env.server_format.format(ip=droplet.ip_address, port=ssh_port))
+            env.server_format.format(ip=droplet['ip_address'], port=ssh_port))
     return roles
@@ -0,0 +1,99 @@
+"""
+Distribute a build artifact to many hosts by letting hosts that already
+have it forward it to the ones that don't.
+
+The deployer uploads the file to a few seed hosts. After that, in every
+round each host holding the file copies it to one host that is still
+missing it, which doubles the number of holders per round. The checksum
+of the file is verified on every host it is copied to. The deployer's
+uplink is then only used for the seeds. Hosts must be able to reach each
+other over SSH with the forwarded agent of the deployer.
+
+The host keys of the other hosts are verified and have to be in the
+``known_hosts`` of each host. Setting ``env.distribute_trust_host_keys``
+skips that check, which lets any machine answering on a host's address
+receive the artifact and use the forwarded agent of the deployer, so it
+should only be used on trusted networks.
+"""
+from __future__ import absolute_import
+
+import hashlib
+
+from fabric.api import env, execute, settings
+from fabric.utils import abort
+from fabric.network import normalize
+
+from .trace import traced
+from .output import notify
+from .operations import put, run
+
+SSH_OPTIONS = '-o BatchMode=yes'
+
+
+def _local_checksum(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _verify(output, checksum, host):
+    if output.split()[:1] != [checksum]:
+        abort('Checksum mismatch for the artifact on {}'.format(host))
+
+
+def _upload(local_path, remote_path, checksum):
+    put(local_path, remote_path)
+    _verify(run('sha1sum {}'.format(remote_path)), checksum,
+            env.host_string)
+
+
+def _ssh_options():
+    if env.get('distribute_trust_host_keys'):
+        return SSH_OPTIONS + ' -o StrictHostKeyChecking=no'
+    return SSH_OPTIONS
+
+
+def _forward(assignments, remote_path, checksum):
+    """ Copy the artifact from the current host to its assigned host """
+    target = assignments[env.host_string]
+    user, host, port = normalize(target)
+    ssh = '{} -p {} {}@{}'.format(_ssh_options(), port, user, host)
+    run('scp {} -P {} {path} {}@{}:{path}'.format(
+        _ssh_options(), port, user, host, path=remote_path))
+    _verify(run('ssh {} sha1sum {}'.format(ssh, remote_path)), checksum,
+            target)
+
+
+@traced
+def distribute(local_path, hosts=None, remote_path=None, seeds=2,
+               pool_size=None):
+    """
+    Copy *local_path* to *remote_path* (defaults to *local_path*) on all
+    *hosts*, uploading it from the deployer to *seeds* hosts only and
+    forwarding it between hosts from there.
+    """
+    hosts = list(hosts or env.hosts)
+    remote_path = remote_path or local_path
+    checksum = _local_checksum(local_path)
+    pool_size = pool_size or env.get('deploy_pool_size') or len(hosts)
+
+    holders, pending = hosts[:seeds], hosts[seeds:]
+    notify('Uploading {} to {} seed host(s)'.format(local_path,
+                                                     len(holders)))
+    with settings(parallel=True, pool_size=pool_size):
+        execute(_upload, local_path, remote_path, checksum, hosts=holders)
+
+    rounds = 0
+    while pending:
+        rounds += 1
+        assignments = dict(zip(holders, pending))
+        pending = pending[len(assignments):]
+        notify('Forwarding {} to {} host(s) in round {}'.format(
+            remote_path, len(assignments), rounds))
+        with settings(parallel=True, pool_size=pool_size,
+                      forward_agent=True):
+            execute(_forward, assignments, remote_path, checksum,
+                    hosts=list(assignments))
+        holders.extend(assignments.values())
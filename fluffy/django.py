@@ -1,9 +1,16 @@
 from __future__ import absolute_import
 
-from fabric.api import env, cd, sudo, runs_once, local, lcd
+import os
+import hashlib
 
+from fabric.utils import abort
+from fabric.api import env, cd, runs_once, local, lcd, settings
+
+from . import static
+from .trace import traced
 from .output import notify
 from .remote import venv_sudo
+from .operations import sudo, exists
 
 
 def run_manage(command):
@@ -16,36 +23,142 @@ def _get_django_version():
     return django.VERSION
 
 
-def generate_static_files():
+@traced
+def generate_static_files(clean=False, static_dir='public/static'):
+    """
+    Build and collect the static files locally and record them in a
+    content-hashed manifest (see :mod:`fluffy.static`).
+
+    Unless *clean* is ``True`` the previously collected files are kept so
+    that ``collectstatic`` only copies files that changed. Add the
+    *static_dir* of ``env.web_dir`` to the ``include_dirs`` of
+    :func:`fluffy.prepare.prepare` to ship the collected files with the
+    build, which makes :func:`collect_static_files` skip the remote
+    ``collectstatic``.
+    """
     with lcd(env.web_dir):
-        local("rm -rf public/static/*")
+        if clean:
+            local("rm -rf {}/*".format(static_dir))
         local("grunt --env=dist")
         local("./manage.py collectstatic --noinput")
 
+    static_root = os.path.join(env.web_dir, static_dir)
+    manifest = static.build_manifest(static_root)
+    changed = static.changed_files(static.read_manifest(static_root), manifest)
+    static.write_manifest(static_root, manifest)
+    notify('{} of {} static files changed'.format(len(changed), len(manifest)))
+
+
+@traced
+def precompress_static_files(static_dir='public/static', use_brotli=False,
+                             processes=None):
+    """
+    Write gzip (and optionally brotli) compressed copies next to the
+    locally collected static files so that the web server can serve them
+    without compressing on every request. Run it after
+    :func:`generate_static_files`; unchanged files are skipped.
+    """
+    if use_brotli:
+        try:
+            import brotli  # noqa
+        except ImportError:
+            abort("Brotli compression requires the 'brotli' package.")
+
+    static_root = os.path.join(env.web_dir, static_dir)
+    compressed = static.precompress(static_root, use_brotli=use_brotli,
+                                    processes=processes)
+    notify('Precompressed {} static files'.format(len(compressed)))
 
+
+@traced
 def run_offline_compressor():
     """ Generate minified CSS and JS as well as pre-compile LESS files. """
     notify('Running offline compression')
     run_manage('compress --follow-links > /dev/null')
 
 
-def collect_static_files():
-    notify("Collecting static files")
+@traced
+def collect_static_files(static_dir='public/static'):
+    """
+    Run ``collectstatic`` on the remote host, unless the build already
+    contains static files collected by :func:`generate_static_files`.
+    """
+    manifest = '{}/{}/{}'.format(env.code_dir, static_dir,
+                                 static.MANIFEST_NAME)
     with cd(env.code_dir):
-        run_manage('collectstatic --noinput > /dev/null')
+        if exists(manifest):
+            notify("Static files were collected for the build, skipping")
+        else:
+            notify("Collecting static files")
+            run_manage('collectstatic --noinput > /dev/null')
         sudo('chmod -R g+w public')
 
 
+def _get_migrations_fingerprint():
+    """
+    Hash the names and contents of all migration files in the new build
+    together with the Django version.
+    """
+    with cd(env.code_dir):
+        files_hash = sudo("find . -path '*/migrations/*.py' -type f -print0 "
+                          "| sort -z | xargs -0 -r sha1sum | sha1sum")
+    return hashlib.sha1('{} {}'.format(
+        files_hash.split()[0], env.django_version)).hexdigest()
+
+
 @runs_once
-def migrate():
-    """ Apply schema migrations based on the Django version used.  """
-    notify("Applying database migrations for Django {}".format(
-        env.django_version))
-
-    if env.django_version[:3] < (1, 7):
-        # Using the command for South migrations
-        run_manage('syncdb --noinput > /dev/null')
-        run_manage('migrate --ignore-ghost-migrations')
-    else:
-        # Using the command for Django's migrations (Django 1.7+)
-        run_manage('migrate --noinput')
+@traced
+def migrate(force=False):
+    """
+    Apply schema migrations based on the Django version used.
+
+    The migrations are skipped if the migration files are the same as for
+    the last successful run, unless *force* is ``True``. A lock directory
+    in ``run/<build>`` prevents concurrent deployments from migrating at
+    the same time.
+
+    The fingerprint and the lock are kept on ``env.migrate_host``, which
+    should be set to the same host by every deployment of a project.
+    Without it they are kept on whichever host the migrations run on
+    first, so deployments to different host lists don't see each other's
+    lock.
+    """
+    if env.get('migrate_host'):
+        with settings(host_string=env.migrate_host):
+            return _migrate(force)
+    return _migrate(force)
+
+
+def _migrate(force):
+    fingerprint_file = '{0.project_dir}/data/{0.build}/migrations.sha1'.format(
+        env)
+    lock_dir = '{0.project_dir}/run/{0.build}/migrate.lock'.format(env)
+
+    fingerprint = _get_migrations_fingerprint()
+    if not force:
+        applied = sudo('cat {} 2>/dev/null || true'.format(fingerprint_file))
+        if applied.strip() == fingerprint:
+            notify('Migrations unchanged since the last deployment, skipping')
+            return
+
+    with settings(warn_only=True):
+        locked = sudo('mkdir {}'.format(lock_dir))
+    if locked.failed:
+        abort('Another deployment is applying migrations. Remove {} if it '
+              'is stale.'.format(lock_dir))
+
+    try:
+        notify("Applying database migrations for Django {}".format(
+            env.django_version))
+
+        if env.django_version[:3] < (1, 7):
+            # Using the command for South migrations
+            run_manage('syncdb --noinput > /dev/null')
+            run_manage('migrate --ignore-ghost-migrations')
+        else:
+            # Using the command for Django's migrations (Django 1.7+)
+            run_manage('migrate --noinput')
+
+        sudo('echo {} > {}'.format(fingerprint, fingerprint_file))
+    finally:
+        sudo('rmdir {}'.format(lock_dir))
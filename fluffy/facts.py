@@ -0,0 +1,101 @@
+"""
+Facts about the current host, collected in a single remote call the first
+time they are needed and kept for the rest of the run.
+
+Tasks that change what the facts describe, like unpacking a build or
+switching the symlink, call :func:`clear_host_facts` so that the facts are
+collected again when they are needed next.
+"""
+from __future__ import absolute_import
+
+from fabric.api import env
+
+from .operations import sudo
+
+_facts = {}
+
+FACTS_SCRIPT = """\
+echo '--- pip'
+{0.virtualenv}/bin/python -c 'import pip; print(pip.__version__)' 2>/dev/null
+echo '--- python'
+{0.virtualenv}/bin/python -c 'import sys; print(sys.version.split()[0])' \
+    2>/dev/null
+echo '--- current'
+if [ -h {0.builds_dir}/{0.build} ]; then
+    basename "$(readlink -f {0.builds_dir}/{0.build})"
+fi
+echo '--- builds'
+find {0.builds_dir} -maxdepth 1 -mindepth 1 -type d -name "{0.build}*" \
+    -printf "%f %T@\\n" 2>/dev/null
+echo '--- disk'
+df -Pk {0.project_dir} 2>/dev/null | tail -n 1
+echo '--- time'
+date +%s
+echo '--- dirs'
+for dir in {dirs}; do if [ -d "$dir" ]; then echo "$dir"; fi; done
+true"""
+
+
+def _layout():
+    """ Directories whose existence is part of the facts """
+    dirs = [env.project_dir, env.builds_dir, env.virtualenv]
+    dirs += ['{}/{}/{}'.format(env.project_dir, name, env.build)
+             for name in ('data', 'logs', 'media', 'run')]
+    if env.get('code_dir'):
+        dirs.append(env.code_dir)
+    return dirs
+
+
+def _parse(output):
+    sections = {}
+    name = None
+    for line in output.splitlines():
+        if line.startswith('--- '):
+            name = line[4:].strip()
+            sections[name] = []
+        elif name and line.strip():
+            sections[name].append(line.strip())
+
+    now = float(sections['time'][0])
+    disk = sections['disk'][0].split() if sections['disk'] else []
+    return {
+        'virtualenv': env.virtualenv,
+        'pip_version': (sections['pip'] or [None])[0],
+        'python_version': (sections['python'] or [None])[0],
+        'current_build': (sections['current'] or [None])[0],
+        'builds': sorted(((build, now - float(mtime)) for build, mtime in
+                          (line.split() for line in sections['builds'])),
+                         reverse=True),
+        'free_kb': int(disk[3]) if len(disk) > 3 else None,
+        'dirs': set(sections['dirs']),
+    }
+
+
+def get_host_facts(refresh=False):
+    """
+    Return a dictionary with the facts about the current host:
+
+    ``pip_version`` and ``python_version``
+        of ``virtualenv``, the virtualenv they were collected from
+    ``current_build``
+        the name of the build directory the ``env.build`` symlink points to
+    ``builds``
+        ``(name, age in seconds)`` of the builds of ``env.build``,
+        newest name first
+    ``free_kb``
+        free disk space of ``env.project_dir``
+    ``dirs``
+        the project directories that exist
+    """
+    key = (env.host_string, env.build)
+    if refresh or key not in _facts:
+        _facts[key] = _parse(sudo(FACTS_SCRIPT.format(
+            env, dirs=' '.join(_layout()))))
+    return _facts[key]
+
+
+def clear_host_facts(host_string=None):
+    """ Forget the facts of *host_string* (the current host by default) """
+    host_string = host_string or env.host_string
+    for key in [key for key in _facts if key[0] == host_string]:
+        del _facts[key]
@@ -0,0 +1,93 @@
+"""
+Per-host log files for the output of remote commands.
+
+When ``env.output_log_dir`` is set, :func:`fluffy.remote.venv_sudo` writes
+the output of commands like ``pip install`` to ``<host>.log`` in that
+directory as it arrives instead of printing it. Only the last
+``env.output_tail_size`` characters are kept in memory for the return
+value and error reporting. The log files are rotated once they reach
+``env.output_log_max_bytes``, keeping ``env.output_log_backups`` old
+files.
+
+Fabric prints the sudo password prompt to the same stream, so this is
+meant for hosts with passwordless sudo or ``env.password`` set.
+"""
+from __future__ import absolute_import
+
+import os
+import re
+
+from fabric.api import env
+
+_logs = {}
+
+
+class RotatingLog(object):
+    """ A file-like object writing to *path* that rotates the file """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._open()
+
+    def _open(self):
+        self.fh = open(self.path, 'a')
+        self.size = self.fh.tell()
+
+    def rotate(self):
+        self.fh.close()
+        for idx in range(self.backups - 1, 0, -1):
+            src = '{}.{}'.format(self.path, idx)
+            if os.path.exists(src):
+                os.rename(src, '{}.{}'.format(self.path, idx + 1))
+        if self.backups:
+            os.rename(self.path, '{}.1'.format(self.path))
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, text):
+        if self.size and self.size + len(text) > self.max_bytes:
+            self.rotate()
+        self.fh.write(text)
+        # Flushed right away so forked workers don't inherit buffered output
+        self.fh.flush()
+        self.size += len(text)
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+
+def host_log(host_string=None):
+    """
+    Return the log of *host_string* (the current host by default) or
+    ``None`` when ``env.output_log_dir`` is not set.
+    """
+    log_dir = env.get('output_log_dir')
+    if not log_dir:
+        return None
+    host_string = host_string or env.host_string or 'localhost'
+    path = os.path.join(log_dir, '{}.log'.format(
+        re.sub(r'[^\w.-]', '_', host_string)))
+    log = _logs.get(path)
+    if log is None:
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        log = _logs[path] = RotatingLog(
+            path, max_bytes=env.get('output_log_max_bytes', 10 * 1024 * 1024),
+            backups=env.get('output_log_backups', 5))
+    return log
+
+
+def tail_size():
+    return env.get('output_tail_size', 64 * 1024)
+
+
+def close_logs():
+    for log in _logs.values():
+        log.close()
+    _logs.clear()
@@ -0,0 +1,154 @@
+"""
+Thin wrappers around the Fabric operations used by fluffy so that every
+remote command and upload is accounted for in :mod:`fluffy.trace` and
+goes through the connections kept by :mod:`fluffy.connections`.
+
+Setting ``env.fluffy_backend`` to ``'local'`` runs the operations against
+the local machine instead, treating remote paths as local ones. This is
+meant for benchmarks and tests that point ``env.project_dir`` and friends
+at a scratch directory.
+"""
+from __future__ import absolute_import
+
+import os
+import shutil
+import posixpath
+import subprocess
+import collections
+
+from fabric import api
+from fabric.api import env
+from fabric.contrib import files
+from fabric.utils import error, apply_lcwd
+from fabric.operations import _AttributeString, _AttributeList
+
+from . import trace
+from .connections import get_client, get_sftp
+
+
+def _size_of(local_path):
+    if hasattr(local_path, 'getvalue'):
+        return len(local_path.getvalue())
+    try:
+        return os.path.getsize(local_path)
+    except (OSError, TypeError):
+        return 0
+
+
+def is_local():
+    return env.get('fluffy_backend') == 'local'
+
+
+def _local_run(command, stdout=None, capture_buffer_size=None):
+    if env.cwd:
+        command = 'cd {} && {}'.format(env.cwd, command)
+    command = '{{\n{}\n}} 2>&1'.format(command)
+    if stdout is None:
+        return api.local(command, capture=True, shell='/bin/bash')
+
+    # Stream the output to *stdout*, keeping at most *capture_buffer_size*
+    # characters of it like Fabric does for remote commands
+    process = subprocess.Popen(['/bin/bash', '-c', command],
+                               stdout=subprocess.PIPE)
+    tail, size = collections.deque(), 0
+    for line in iter(process.stdout.readline, ''):
+        stdout.write(line)
+        tail.append(line)
+        size += len(line)
+        while capture_buffer_size and size > capture_buffer_size:
+            size -= len(tail.popleft())
+
+    result = _AttributeString(''.join(tail).rstrip('\n'))
+    result.return_code = process.wait()
+    result.failed = result.return_code != 0
+    result.succeeded = not result.failed
+    if result.failed and not env.warn_only:
+        error('local() encountered an error (return code {}) while '
+              'executing {!r}'.format(result.return_code, command),
+              stdout=result)
+    return result
+
+
+def _local_put(local_path, remote_path, mode=None):
+    if os.path.isdir(remote_path):
+        remote_path = os.path.join(remote_path, os.path.basename(local_path))
+    if hasattr(local_path, 'getvalue'):
+        with open(remote_path, 'w') as fh:
+            fh.write(local_path.getvalue())
+    elif os.path.abspath(local_path) != os.path.abspath(remote_path):
+        shutil.copyfile(local_path, remote_path)
+    if mode:
+        os.chmod(remote_path, int(str(mode), 8))
+    return [remote_path]
+
+
+def _pooled_put(local_path, remote_path, use_sudo=False,
+                mirror_local_mode=False, mode=None, temp_dir=''):
+    """
+    Upload a single file through the pooled SFTP session, reporting errors
+    like Fabric's ``put()``
+    """
+    if not posixpath.isabs(remote_path) and env.get('cwd'):
+        remote_path = posixpath.join(env.cwd, remote_path)
+    local_is_path = not hasattr(local_path, 'read')
+    remote_paths, failed = [], []
+    try:
+        remote_paths.append(get_sftp().put(
+            local_path, remote_path, use_sudo, mirror_local_mode, mode,
+            local_is_path, temp_dir))
+    except Exception as exc:
+        failed.append(local_path if local_is_path else '<StringIO>')
+        error(message="put() encountered an exception while uploading "
+                      "'{}'".format(local_path), exception=exc)
+    result = _AttributeList(remote_paths)
+    result.failed = failed
+    result.succeeded = not failed
+    return result
+
+
+def sudo(command, *args, **kwargs):
+    trace.record_command()
+    if is_local():
+        return _local_run(command, kwargs.get('stdout'),
+                          kwargs.get('capture_buffer_size'))
+    get_client()
+    return api.sudo(command, *args, **kwargs)
+
+
+def run(command, *args, **kwargs):
+    trace.record_command()
+    if is_local():
+        return _local_run(command, kwargs.get('stdout'),
+                          kwargs.get('capture_buffer_size'))
+    get_client()
+    return api.run(command, *args, **kwargs)
+
+
+def put(local_path=None, remote_path=None, *args, **kwargs):
+    # Resolve local paths like Fabric's put() does, relative to lcd()
+    source = local_path
+    if local_path and not hasattr(local_path, 'read'):
+        source = apply_lcwd(os.path.expanduser(local_path), env)
+
+    trace.record_bytes(_size_of(source))
+    if is_local():
+        return _local_put(source, remote_path or source,
+                          mode=kwargs.get('mode'))
+
+    single_file = (hasattr(source, 'read') or
+                   (source and os.path.isfile(source)))
+    pooled_kwargs = set(['use_sudo', 'mirror_local_mode', 'mode',
+                         'temp_dir'])
+    if (single_file and remote_path and not args and
+            not remote_path.startswith('~') and
+            set(kwargs) <= pooled_kwargs):
+        return _pooled_put(source, remote_path, **kwargs)
+    return api.put(local_path, remote_path, *args, **kwargs)
+
+
+def exists(path, use_sudo=False, verbose=False):
+    trace.record_command()
+    if is_local():
+        return os.path.exists(path)
+    get_client()
+    return files.exists(path, use_sudo=use_sudo, verbose=verbose)
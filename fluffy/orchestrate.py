@@ -0,0 +1,187 @@
+from __future__ import absolute_import
+
+from fabric.api import env, execute, settings
+from fabric.utils import abort
+
+from . import trace
+from .output import notify
+from .distribute import distribute
+from .remote import (deploy_codebase, unpack, unpack_wheelhouse,
+                     update_virtualenv, switch_symlink,
+                     restart_supervisord_services, rollback)
+
+
+def _unpack_step(step):
+    """
+    Normalise *step* into a ``(func, args, kwargs)`` tuple. A step is
+    either a callable or a tuple of a callable followed by its positional
+    and (optionally) keyword arguments.
+    """
+    if callable(step):
+        return step, (), {}
+    func, args = step[0], tuple(step[1]) if len(step) > 1 else ()
+    kwargs = dict(step[2]) if len(step) > 2 else {}
+    return func, args, kwargs
+
+
+def _step_name(step):
+    func = _unpack_step(step)[0]
+    return getattr(func, '__name__', repr(func))
+
+
+def _run_steps(steps):
+    """
+    Run *steps* in order on the current host and return a picklable
+    summary, including the recorded trace events, so that it can be sent
+    back from a parallel worker.
+    """
+    since = trace.mark()
+    result = {'ok': True, 'step': None, 'error': None}
+    for step in steps:
+        func, args, kwargs = _unpack_step(step)
+        try:
+            # Failing commands have to stop the host, even though execute()
+            # runs with warn_only to not abort on a single host
+            with settings(warn_only=False):
+                func(*args, **kwargs)
+        except (Exception, SystemExit) as exc:
+            result = {'ok': False, 'step': _step_name(step),
+                      'error': str(exc) or exc.__class__.__name__}
+            break
+    result['events'] = trace.take_events(since)
+    return result
+
+
+def _batches(hosts, batch_size):
+    for idx in range(0, len(hosts), batch_size):
+        yield hosts[idx:idx + batch_size]
+
+
+def _report(results):
+    failed = [h for h, r in sorted(results.items()) if not r['ok']]
+    notify('{} host(s) succeeded, {} failed'.format(
+        len(results) - len(failed), len(failed)))
+    for host in failed:
+        print "[{}] failed in step '{}': {}".format(
+            host, results[host]['step'], results[host]['error'])
+
+
+def run_in_batches(steps, hosts=None, batch_size=None, pool_size=None,
+                   max_failures=None):
+    """
+    Run *steps* on *hosts* in batches of *batch_size* hosts, with up to
+    *pool_size* hosts of a batch being worked on concurrently.
+
+    Each host runs all *steps* in order and stops at its first failing
+    step. Once more than *max_failures* hosts have failed, the remaining
+    batches are not started and the deployment is aborted. Defaults are
+    taken from ``env.deploy_batch_size``, ``env.deploy_pool_size`` and
+    ``env.deploy_max_failures``.
+
+    Returns a dictionary mapping each host that was attempted to a
+    dictionary with the keys ``ok``, ``step`` and ``error``.
+    """
+    hosts = list(hosts or env.hosts)
+    if not hosts:
+        abort('No hosts to deploy to.')
+
+    batch_size = int(batch_size or env.get('deploy_batch_size') or len(hosts))
+    pool_size = int(pool_size or env.get('deploy_pool_size') or batch_size)
+    if max_failures is None:
+        max_failures = env.get('deploy_max_failures', 0)
+
+    results = {}
+    failures = 0
+    batches = list(_batches(hosts, batch_size))
+    for idx, batch in enumerate(batches, 1):
+        notify('Running {} on batch {} of {} ({} hosts)'.format(
+            ', '.join(_step_name(s) for s in steps),
+            idx, len(batches), len(batch)))
+
+        with settings(parallel=pool_size > 1, pool_size=pool_size,
+                      warn_only=True):
+            batch_results = execute(_run_steps, steps, hosts=batch)
+
+        for host, result in batch_results.items():
+            if not isinstance(result, dict):
+                # The worker died before it could report back
+                result = {'ok': False, 'step': None,
+                          'error': str(result) or 'unknown error'}
+            trace.add_events(result.pop('events', []))
+            results[host] = result
+            failures += not result['ok']
+
+        if failures > max_failures:
+            _report(results)
+            abort('{} host(s) failed, exceeding the limit of {}. Skipping '
+                  'the remaining {} batch(es).'.format(
+                      failures, max_failures, len(batches) - idx))
+
+    _report(results)
+    return results
+
+
+def deploy(hosts=None, batch_size=None, pool_size=None, max_failures=None,
+           seeds=None):
+    """
+    Deploy the prepared build (see :func:`fluffy.prepare.prepare`) to
+    *hosts* in batches using :func:`run_in_batches`.
+
+    With *seeds* the build is uploaded to that many hosts only and copied
+    from host to host by :func:`fluffy.distribute.distribute` first. If a
+    wheelhouse was built (see :func:`fluffy.prepare.build_wheelhouse`) it
+    is shipped along and the requirements are installed from it.
+    """
+    if seeds:
+        hosts = list(hosts or env.hosts)
+        distribute(env.build_file, hosts, seeds=seeds, pool_size=pool_size)
+        steps = [(unpack, (env.build_file,))]
+        if env.get('wheelhouse_file'):
+            distribute(env.wheelhouse_file, hosts, seeds=seeds,
+                       pool_size=pool_size)
+            steps.append((unpack_wheelhouse, (env.wheelhouse_file,)))
+    else:
+        steps = [(deploy_codebase, (env.build_file, env.version))]
+
+    if env.get('wheelhouse_file'):
+        # Install from the wheels unpacked into the build
+        steps.append((update_virtualenv, (), {'wheelhouse': 'wheelhouse'}))
+    else:
+        steps.append(update_virtualenv)
+
+    steps += [
+        switch_symlink,
+        restart_supervisord_services,
+    ]
+    return run_in_batches(steps, hosts=hosts, batch_size=batch_size,
+                          pool_size=pool_size, max_failures=max_failures)
+
+
+def rolling_restart(hosts=None, min_capacity=0.75, health_url=None,
+                    timeout=60):
+    """
+    Restart the supervisor processes host by host in batches small enough
+    to keep at least *min_capacity* of the hosts serving. Each host waits
+    for *health_url* before the next batch starts, and the restart stops at
+    the first host that fails its health check.
+    """
+    hosts = list(hosts or env.hosts)
+    batch_size = max(1, int(len(hosts) * (1 - min_capacity)))
+    steps = [(restart_supervisord_services, (),
+              {'rolling': True, 'health_url': health_url,
+               'timeout': timeout})]
+    return run_in_batches(steps, hosts=hosts, batch_size=batch_size,
+                          pool_size=batch_size, max_failures=0)
+
+
+def rollback_all(hosts=None, build_dir=None, batch_size=None,
+                 pool_size=None, rolling=False, health_url=None):
+    """
+    Roll *hosts* back to *build_dir* (by default each host's previous
+    build) with :func:`fluffy.remote.rollback`. All hosts are switched at
+    once unless *batch_size* is given.
+    """
+    steps = [(rollback, (build_dir,),
+              {'rolling': rolling, 'health_url': health_url})]
+    return run_in_batches(steps, hosts=hosts, batch_size=batch_size,
+                          pool_size=pool_size, max_failures=0)
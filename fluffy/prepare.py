@@ -1,15 +1,31 @@
 from __future__ import absolute_import
 
 import os
+import time
+import shutil
+import tarfile
+import hashlib
 import datetime
+import tempfile
+import subprocess
 import contextlib
+import multiprocessing
+from StringIO import StringIO
+from distutils.spawn import find_executable
 
+from fabric.state import output
 from fabric.colors import red
+from fabric.utils import abort
 from fabric.operations import prompt
-from fabric.api import env, local, runs_once
+from fabric.api import env, local, runs_once, execute, settings
 
+from .trace import traced
 from .output import notify
 from .django import _get_django_version
+from .remote import get_deployed_refspec
+
+PATCH_MARKER = '.fluffy-patch'
+DELETED_LIST = '.fluffy-deleted'
 
 
 def _get_current_branch_name():
@@ -88,28 +104,301 @@ def select_deployment(repo='origin'):
     set_reference_to_deploy_from(branch)
 
 
-def prepare(repo='origin', include_dirs=None):
-    env.django_version = _get_django_version()
+def _hash_paths(paths):
+    """
+    Return a SHA1 hex digest over the names and contents of all files in
+    *paths*, which may be files or directories.
+    """
+    digest = hashlib.sha1()
+    for top in paths:
+        if os.path.isfile(top):
+            walk = [(os.path.dirname(top), [], [os.path.basename(top)])]
+        else:
+            walk = os.walk(top)
+        for root, dirs, files in walk:
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(path)
+                with open(path, 'rb') as fh:
+                    for chunk in iter(lambda: fh.read(1024 * 1024), ''):
+                        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _build_cache_key(include_dirs, base=None):
+    """
+    Derive the cache key for the current build from the git tree of
+    ``env.web_dir`` at ``env.version``, the contents of *include_dirs* and
+    the *base* commit of patch builds.
+    """
+    tree = local('git rev-parse {}:{}'.format(env.version, env.web_dir),
+                 capture=True).strip()
+    parts = [
+        'tree:{}'.format(tree),
+        'web_dir:{}'.format(env.web_dir),
+        'include_dirs:{}'.format(' '.join(include_dirs)),
+        'include_hash:{}'.format(_hash_paths(include_dirs)),
+    ]
+    if base:
+        parts.append('base:{}'.format(base))
+    return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _evict_build_cache(cache_dir, max_age, max_size):
+    """
+    Remove cached artifacts older than *max_age* seconds and then the least
+    recently used ones until the cache is no larger than *max_size* bytes.
+    """
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        stat = os.stat(path)
+        if now - stat.st_mtime > max_age:
+            os.remove(path)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+
+
+# Compressors for streaming builds in order of preference, the first one
+# that is installed is used.
+COMPRESSORS = {
+    'gz': [['pigz', '-c', '-p', '{threads}'], ['gzip', '-c']],
+    'zst': [['zstd', '-q', '-c', '-T{threads}']],
+}
+
+
+def _get_compressor(compression):
+    threads = env.get('build_threads') or multiprocessing.cpu_count()
+    for command in COMPRESSORS.get(compression, []):
+        if find_executable(command[0]):
+            return [arg.format(threads=threads) for arg in command]
+    abort('No compressor available for "{}" archives, tried: {}'.format(
+        compression,
+        ', '.join(c[0] for c in COMPRESSORS.get(compression, []))))
+
+
+def _stream_archive(build_file, include_dirs, compression, members=None,
+                    extra=None):
+    """
+    Write the git archive of ``env.web_dir`` at ``env.version`` together
+    with *include_dirs* as a single tar stream through a (multi-threaded)
+    compressor into *build_file*, without an intermediate tar file.
+
+    *members* limits the files taken from the git archive to the given
+    paths, and *extra* is a list of ``(path, content)`` tuples of files to
+    add to the archive.
+    """
+    compressor = _get_compressor(compression)
+    if output.running:
+        print '[localhost] stream: git archive {} {} | {} > {}'.format(
+            env.version, env.web_dir, ' '.join(compressor), build_file)
+
+    with open(build_file, 'wb') as fh:
+        packer = subprocess.Popen(compressor, stdin=subprocess.PIPE,
+                                  stdout=fh)
+        archive = subprocess.Popen(
+            ['git', 'archive', '--format', 'tar', str(env.version),
+             env.web_dir],
+            stdout=subprocess.PIPE)
+
+        try:
+            source = tarfile.open(fileobj=archive.stdout, mode='r|')
+        except tarfile.ReadError:
+            # git archive failed before writing anything, e.g. for an
+            # unknown refspec
+            packer.kill()
+            packer.wait()
+            abort("git archive encountered an error (return code {}) while "
+                  "streaming '{}'".format(archive.wait(), env.version))
+        target = tarfile.open(fileobj=packer.stdin, mode='w|',
+                              format=tarfile.PAX_FORMAT)
+        for member in source:
+            if members is not None and member.name not in members:
+                continue
+            fileobj = source.extractfile(member) if member.isreg() else None
+            target.addfile(member, fileobj)
+        for path in include_dirs:
+            target.add(path)
+        for path, content in extra or []:
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            info.mtime = time.time()
+            target.addfile(info, StringIO(content))
+        target.close()
+        source.close()
+        packer.stdin.close()
+
+        if archive.wait() or packer.wait():
+            abort('Streaming the build archive to {} failed'.format(
+                build_file))
+
+
+def _resolve_base(base):
+    """
+    Return *base*, the refspec to build a patch against, and its commit ID
+    or ``(None, None)`` if it is not known locally. With ``'deployed'``
+    the refspec the hosts currently run is used if it is the same on all
+    of them.
+    """
+    if base == 'deployed':
+        refspecs = set(execute(get_deployed_refspec,
+                               hosts=env.hosts).values()) if env.hosts else []
+        if len(refspecs) != 1 or None in refspecs:
+            notify('The hosts run different or unknown builds')
+            return None, None
+        base = refspecs.pop()
+
+    with settings(warn_only=True):
+        commit = local('git rev-parse --verify --quiet {}^{{commit}}'.format(
+            base), capture=True)
+    if commit.failed:
+        notify('Refspec {} is not available locally'.format(base))
+        return None, None
+    return base, commit.strip()
+
+
+def _get_patch_contents(base):
+    """
+    Return the paths in ``env.web_dir`` that were added or changed between
+    the *base* commit and ``env.version`` and the list of deleted paths
+    relative to ``env.web_dir``.
+
+    The cron files are always included, because ``deploy_cronjobs()``
+    moves them out of the build they are copied from.
+    """
+    output = local('git diff --name-status --no-renames -z {} {} -- {}'.format(
+        base, env.version, env.web_dir), capture=True)
+    fields = output.split('\0')
+    changed, deleted = set(), []
+    for status, path in zip(fields[::2], fields[1::2]):
+        if status == 'D':
+            relpath = os.path.relpath(path, env.web_dir)
+            deleted.append(relpath)
+            if relpath.endswith('.py'):
+                deleted.append(relpath + 'c')
+        else:
+            changed.add(path)
+
+    cron_files = local('git ls-tree -r -z --name-only {} -- {}'.format(
+        env.version, os.path.join(env.web_dir, 'deploy', 'cron.d')),
+        capture=True)
+    changed.update(path for path in cron_files.split('\0') if path)
+    return changed, deleted
+
+
+@traced
+def prepare(repo='origin', include_dirs=None, use_cache=True,
+            streaming=False, compression='gz', base=None):
+    """
+    Build the archive for ``env.version`` and store its path in
+    ``env.build_file``.
+
+    Unless *use_cache* is ``False``, artifacts are kept in
+    ``env.build_cache_dir`` keyed by the git tree being deployed and the
+    contents of *include_dirs*, and an existing artifact is reused instead
+    of building it again. The cache is limited by
+    ``env.build_cache_max_age`` (seconds) and ``env.build_cache_max_size``
+    (bytes).
+
+    With *streaming* the archive is written in a single pass through a
+    multi-threaded compressor (``pigz`` or ``zstd``) instead of writing,
+    appending to and then compressing a tar file. *compression* selects
+    ``gz`` or, for streaming builds only, ``zst`` archives.
+
+    With *base*, a refspec or ``'deployed'`` for the one the hosts run,
+    the archive only contains the files that changed since *base* and is
+    applied on top of a copy of the current build by
+    :func:`fluffy.remote.unpack`. A full archive is built if *base* is
+    not in the local history. ``env.build_base`` is set to the base
+    refspec of patch archives and ``None`` otherwise.
+    """
+    if compression != 'gz' and not streaming:
+        abort('Only gzip compression is supported without streaming.')
+
+    env.build_base, base_commit = _resolve_base(base) if base else (None, None)
+
+    if not env.get('django_version'):
+        env.django_version = _get_django_version()
     env.initial_branch = _get_current_branch_name()
 
     notify('BUILDING TO %s' % env.build.upper())
 
     include_dirs = include_dirs or []
 
-    # Create a build file ready to be pushed to the servers
-    notify("Building from refspec %s" % env.version)
-
     tar_file = '/tmp/build-{}.tar'.format(str(env.version).replace('/', '-'))
-    env.build_file = '{}.gz'.format(tar_file)
+    if base_commit:
+        tar_file = '{}-from-{}.tar'.format(tar_file[:-4], base_commit[:12])
+    env.build_file = '{}.{}'.format(tar_file, compression)
 
-    local('git archive --format tar {} {} -o {}'.format(
-        env.version, env.web_dir, tar_file))
+    cached_file = None
+    if use_cache:
+        cache_dir = env.get('build_cache_dir') or '/tmp/fluffy-build-cache'
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cached_file = os.path.join(
+            cache_dir, '{}.tar.{}'.format(
+                _build_cache_key(include_dirs, base_commit), compression))
 
-    if include_dirs:
-        local('tar rf {tar} {dirs}'.format(
-            dirs=' '.join(include_dirs), tar=tar_file))
+    if cached_file and os.path.exists(cached_file):
+        notify("Reusing cached build of refspec %s" % env.version)
+        os.utime(cached_file, None)
+        _link_or_copy(cached_file, env.build_file)
+    else:
+        # Create a build file ready to be pushed to the servers
+        notify("Building from refspec %s" % env.version)
+
+        # The previous artifact may be hard linked into the cache
+        for path in (tar_file, env.build_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+        if base_commit:
+            changed, deleted = _get_patch_contents(base_commit)
+            notify('Building patch with {} changed and {} deleted files '
+                   'since {}'.format(len(changed), len(deleted),
+                                     env.build_base))
+            _stream_archive(env.build_file, include_dirs, compression,
+                            members=changed, extra=[
+                                (os.path.join(env.web_dir, PATCH_MARKER),
+                                 env.build_base),
+                                (os.path.join(env.web_dir, DELETED_LIST),
+                                 '\0'.join(deleted))])
+        elif streaming:
+            _stream_archive(env.build_file, include_dirs, compression)
+        else:
+            local('git archive --format tar {} {} -o {}'.format(
+                env.version, env.web_dir, tar_file))
 
-    local('gzip -f {} > {}'.format(tar_file, env.build_file))
+            if include_dirs:
+                local('tar rf {tar} {dirs}'.format(
+                    dirs=' '.join(include_dirs), tar=tar_file))
+
+            local('gzip -f {} > {}'.format(tar_file, env.build_file))
+
+        if cached_file:
+            _link_or_copy(env.build_file, cached_file)
+            _evict_build_cache(
+                os.path.dirname(cached_file),
+                max_age=env.get('build_cache_max_age') or 7 * 24 * 3600,
+                max_size=env.get('build_cache_max_size') or 2 * 1024 ** 3)
 
     # Set timestamp now so it is the same on all servers after deployment
     now = datetime.datetime.now()
@@ -117,6 +406,46 @@ def prepare(repo='origin', include_dirs=None):
     env.code_dir = '%s/%s' % (env.builds_dir, env.build_dir)
 
 
+@traced
+def build_wheelhouse(requirements_dir=None):
+    """
+    Build wheels for the requirements of ``env.build`` and package them as
+    ``env.wheelhouse_file`` to be shipped with the build.
+
+    The requirements are read from *requirements_dir* (defaults to
+    ``<web_dir>/deploy/requirements``) as committed at ``env.version``, so
+    they match the ones in the build, and wheels are built locally once
+    per git tree of that directory. The local platform and Python version
+    need to match the ones on the remote hosts for packages with C
+    extensions.
+    """
+    requirements_dir = requirements_dir or os.path.join(
+        env.web_dir, 'deploy', 'requirements')
+    req_hash = local('git rev-parse {}:{}'.format(
+        env.version, requirements_dir), capture=True).strip()[:12]
+
+    wheel_dir = '/tmp/fluffy-wheelhouse-{}'.format(req_hash)
+    env.wheelhouse_file = '/tmp/wheelhouse-{}.tar.gz'.format(req_hash)
+
+    if os.path.exists(env.wheelhouse_file):
+        notify('Reusing wheelhouse for requirements {}'.format(req_hash))
+        return
+
+    notify('Building wheelhouse for requirements {}'.format(req_hash))
+    export_dir = tempfile.mkdtemp(prefix='fluffy-requirements-')
+    try:
+        local('git archive --format tar {} {} | tar -x -C {}'.format(
+            env.version, requirements_dir, export_dir))
+        local('pip wheel --wheel-dir={} -r {}'.format(
+            wheel_dir, os.path.join(export_dir, requirements_dir,
+                                    '{}.txt'.format(env.build))))
+    finally:
+        shutil.rmtree(export_dir)
+    local('tar czf {}.partial -C {} . && mv {}.partial {}'.format(
+        env.wheelhouse_file, wheel_dir, env.wheelhouse_file,
+        env.wheelhouse_file))
+
+
 @runs_once
 def update_codebase(branch, repo):
     """
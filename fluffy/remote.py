@@ -1,40 +1,299 @@
 from __future__ import absolute_import
 
+import os
+import time
+import uuid
+import tarfile
+import hashlib
+import contextlib
 from StringIO import StringIO
 from distutils.version import LooseVersion
 
-from jinja2 import Template
-
-from fabric.operations import put
-from fabric.api import env, sudo, cd
-from fabric.contrib.files import exists
+from fabric.utils import abort
+from fabric.api import env, cd, settings, show
 
+from .trace import traced
 from .output import notify
+from .logs import host_log, tail_size
+from .facts import get_host_facts, clear_host_facts
+from .operations import sudo, put, exists
 
 
 def _get_pip_version():
     """ Get version string for remote installed pip (in virtualenv) """
+    facts = get_host_facts()
+    if facts['virtualenv'] == env.virtualenv and facts['pip_version']:
+        return facts['pip_version']
     return venv_sudo("python -c 'import pip; print pip.__version__'")
 
 
-def venv_sudo(command):
+def _venv_command(command):
     venv = 'source {0.virtualenv}/bin/activate'.format(env)
-    return sudo("{} && {}".format(venv, command))
+    return "{} && {}".format(venv, command)
 
 
-def delete_old_builds():
-    notify('Deleting old builds')
-    with cd(env.builds_dir):
-        sudo('find . -maxdepth 1 -type d -name "%(build)s*" | sort -r | '
-             'sed "1,5d" | xargs rm -rf' % env)
+def venv_sudo(command):
+    """
+    Run *command* in the virtualenv. With ``env.output_log_dir`` set the
+    output is streamed to the host's log (see :mod:`fluffy.logs`) and only
+    its tail is kept in memory.
+    """
+    log = host_log()
+    if log is None:
+        return sudo(_venv_command(command))
+
+    # Fabric only writes shown output to the streams, which are the log
+    with settings(show('stdout', 'stderr'), warn_only=True):
+        result = sudo(_venv_command(command), stdout=log, stderr=log,
+                      capture_buffer_size=tail_size())
+    if result.failed and not env.warn_only:
+        abort("'{}' failed with exit code {}, see {}:\n{}".format(
+            command, result.return_code, log.path, result))
+    return result
+
+
+class SudoBatch(object):
+    """
+    Collects ``sudo`` commands and runs them as a single remote script
+    in one round trip. Each command keeps the working directory that was
+    active when it was added. The script stops at the first failing
+    command and the deployment is aborted with that command and its
+    output.
+    """
+    marker = '__fluffy_batch__'
+
+    def __init__(self):
+        self.commands = []
+
+    def sudo(self, command):
+        self.commands.append((env.cwd, command))
+
+    def venv_sudo(self, command):
+        self.sudo(_venv_command(command))
+
+    def script(self):
+        lines = []
+        for idx, (cwd, command) in enumerate(self.commands):
+            if cwd:
+                command = 'cd {} && {}'.format(cwd, command)
+            lines.append(
+                'echo "{marker} {idx}"; ( {command} ) || '
+                '{{ rc=$?; echo "{marker} {idx} failed $rc"; exit $rc; }}'
+                .format(marker=self.marker, idx=idx, command=command))
+        return '\n'.join(lines)
+
+    def _failure(self, output):
+        """ Return index, exit code and output of the failed command """
+        idx, code, lines = None, None, []
+        for line in output.splitlines():
+            parts = line.strip().split()
+            if parts[:1] != [self.marker]:
+                lines.append(line)
+            elif len(parts) == 4 and parts[2] == 'failed':
+                idx, code = int(parts[1]), parts[3]
+            else:
+                lines = []
+        return idx, code, '\n'.join(lines)
+
+    def run(self):
+        if not self.commands:
+            return
+        with settings(warn_only=True):
+            result = sudo(self.script())
+        if result.failed:
+            idx, code, output = self._failure(result)
+            if idx is None:
+                abort('Batched commands failed:\n{}'.format(result))
+            abort('Batched command {} of {} failed with exit code {}: {}'
+                  '\n{}'.format(idx + 1, len(self.commands), code,
+                                 self.commands[idx][1], output))
+        return result
+
+
+@contextlib.contextmanager
+def sudo_batch():
+    """
+    Context manager that yields a :class:`SudoBatch` and runs the collected
+    commands in one remote call when the block is left without errors.
+    """
+    batch = SudoBatch()
+    yield batch
+    batch.run()
 
 
+def _discard(paths, trash_dir, background=True):
+    """
+    Atomically move *paths* into a fresh directory below *trash_dir* and
+    delete them, by default in a detached low-priority process so that the
+    deployment does not wait for it.
+    """
+    if not paths:
+        return
+    command = ('mkdir -p {trash} && t=$(mktemp -d {trash}/run.XXXXXX) && '
+               'mv {paths} "$t"/ && '.format(trash=trash_dir,
+                                            paths=' '.join(paths)))
+    if background:
+        command += ('(setsid nohup nice -n 19 '
+                    '$(command -v ionice > /dev/null && echo ionice -c3) '
+                    'rm -rf "$t" > /dev/null 2>&1 &)')
+    else:
+        command += 'rm -rf "$t"'
+    sudo(command, pty=False)
+
+
+def _select_old_builds(builds, protected, keep, max_age=None, min_free=None,
+                       free=None, sizes=None):
+    """
+    Return the builds to delete from *builds*, a list of ``(name, age)``
+    tuples sorted newest first with the age in seconds.
+
+    Builds beyond the newest *keep* and builds older than *max_age* seconds
+    are selected. If *min_free* (KB) is given, further builds are selected
+    oldest first until *free* plus the *sizes* (KB per name) of the
+    selected builds reaches it. Builds in *protected* are never selected.
+    """
+    candidates = [name for name, _ in builds if name not in protected]
+    victims = set(name for name, _ in builds[keep:])
+    if max_age is not None:
+        victims.update(name for name, age in builds if age > max_age)
+    victims &= set(candidates)
+
+    if min_free is not None:
+        free += sum(sizes.get(name, 0) for name in victims)
+        for name in reversed(candidates):
+            if free >= min_free:
+                break
+            if name not in victims:
+                victims.add(name)
+                free += sizes.get(name, 0)
+
+    return [name for name in candidates if name in victims]
+
+
+@traced
+def delete_old_builds(keep=5, max_age=None, min_free=None, background=True):
+    """
+    Delete old builds of ``env.build`` according to the retention policy.
+
+    The newest *keep* builds are retained, builds older than *max_age*
+    days are deleted regardless and, if *min_free* (GB) is given, more
+    builds are deleted oldest first until at least that much disk space
+    will be free. The build the symlink points to and the build being
+    deployed are never deleted. Unless *background* is ``False`` the
+    builds are moved to ``.trash`` and deleted in a detached, low priority
+    process.
+    """
+    notify('Deleting old builds')
+    facts = get_host_facts()
+    builds = facts['builds']
+    protected = set([facts['current_build'], env.get('build_dir')])
+
+    if min_free is not None and facts['free_kb'] is None:
+        print 'Free disk space of {} is unknown, ignoring min_free'.format(
+            env.project_dir)
+        min_free = None
+
+    sizes = {}
+    if min_free is not None:
+        names = [name for name, _ in builds if name not in protected]
+        if names:
+            with cd(env.builds_dir):
+                sizes = dict(
+                    (name, int(size)) for size, name in
+                    (line.split() for line in sudo(
+                        'du -sk {}'.format(' '.join(names))).splitlines()))
+        min_free = min_free * 1024 ** 2
+
+    victims = _select_old_builds(
+        builds, protected, keep,
+        max_age=max_age * 24 * 3600 if max_age is not None else None,
+        min_free=min_free, free=facts['free_kb'], sizes=sizes)
+
+    if victims:
+        notify('Deleting {} old build(s)'.format(len(victims)))
+        with cd(env.builds_dir):
+            _discard(victims, '.trash', background=background)
+        clear_host_facts()
+    delete_unused_virtualenvs(background=background)
+
+
+def delete_unused_virtualenvs(background=True):
+    """
+    Delete virtualenvs created by ``update_virtualenv(keyed_by_hash=True)``
+    that are no longer linked from any of the remaining builds.
+    """
+    with cd('{0.project_dir}/virtualenvs'.format(env)):
+        venvs = sudo('find "$(pwd)" -maxdepth 1 -type d -name '
+                     '"%(build)s-????????????"' % env).split()
+    in_use = sudo('for link in %(builds_dir)s/*/venv; do '
+                  'readlink -e "$link" || true; done' % env).split()
+    unused = set(venvs) - set(in_use) - set([env.virtualenv])
+    if unused:
+        notify('Deleting {} unused virtualenv(s)'.format(len(unused)))
+        _discard(sorted(unused), '{0.project_dir}/virtualenvs/.trash'.format(
+            env), background=background)
+
+
+def _switch_to_keyed_virtualenv():
+    """
+    Point ``env.virtualenv`` to the virtualenv for the hash of the
+    requirements files in the new build, creating it by cloning the
+    virtualenv of the current build if necessary. Returns ``True`` if a
+    complete virtualenv for this hash already exists.
+    """
+    with cd(env.code_dir):
+        req_hash = sudo('cat deploy/requirements/*.txt | sha1sum | '
+                        'cut -c1-12').strip()
+    venv = '{0.project_dir}/virtualenvs/{0.build}-{1}'.format(env, req_hash)
+
+    if exists('{}/.fluffy-complete'.format(venv)):
+        notify('Requirements unchanged, reusing virtualenv {}'.format(venv))
+        env.virtualenv = venv
+        return True
+
+    # Not env.virtualenv, which points to the keyed one of the last host
+    previous = sudo('readlink -e %(builds_dir)s/%(build)s/venv || '
+                    'echo %(project_dir)s/virtualenvs/%(build)s' % env).strip()
+    notify('Creating virtualenv {} from {}'.format(venv, previous))
+    sudo('rm -rf {0} && if which virtualenv-clone > /dev/null; then '
+         'virtualenv-clone {1} {0}; else '
+         '`which virtualenv` --no-site-packages {0} && '
+         'echo "export DJANGO_CONF=\"conf.{2}\"" >> {0}/bin/activate; '
+         'fi'.format(venv, previous, env.build))
+    env.virtualenv = venv
+    return False
+
+
+@traced
 def update_virtualenv(use_wheels=True, update=True, exists_action='w',
-                      options=None, insecure_packages=None):
+                      options=None, insecure_packages=None,
+                      keyed_by_hash=False, wheelhouse=None):
     """
     Install the dependencies in the requirements file
+
+    With *keyed_by_hash* each set of requirements gets its own virtualenv
+    in ``virtualenvs/<build>-<hash>`` which is linked from the build as
+    ``venv``. Installing is skipped if the requirements did not change
+    and otherwise only the differences are installed into a clone of the
+    current build's virtualenv. ``env.virtualenv`` is updated to the new
+    virtualenv. Configuration that should follow the deployed build can
+    use ``<builds_dir>/<build>/venv`` as the virtualenv path.
+
+    With *wheelhouse*, a directory relative to the build (see
+    :func:`unpack_wheelhouse`), packages are only installed from the
+    wheels in that directory without accessing the package index.
     """
-    options = options or ['--download-cache=/root/.pip/cache']
+    if keyed_by_hash:
+        ready = _switch_to_keyed_virtualenv()
+        if ready:
+            sudo('ln -sfn %(virtualenv)s %(code_dir)s/venv' % env)
+            return
+
+    if wheelhouse:
+        options = (options or []) + [
+            '--no-index', '--find-links={}'.format(wheelhouse)]
+    else:
+        options = options or ['--download-cache=/root/.pip/cache']
 
     if use_wheels:
         options.append('--use-wheel')
@@ -44,6 +303,9 @@ def update_virtualenv(use_wheels=True, update=True, exists_action='w',
 
     pip_version = _get_pip_version()
 
+    if wheelhouse and LooseVersion(pip_version) >= LooseVersion('7.0'):
+        options.append('--only-binary=:all:')
+
     insecure_packages = insecure_packages or []
     for pkg in insecure_packages:
         options.append('--allow-external {}'.format(pkg))
@@ -57,37 +319,182 @@ def update_virtualenv(use_wheels=True, update=True, exists_action='w',
 
     with cd(env.code_dir):
         venv_sudo(' '.join(command))
+    clear_host_facts()
+
+    if keyed_by_hash:
+        sudo('touch %(virtualenv)s/.fluffy-complete && '
+             'ln -sfn %(virtualenv)s %(code_dir)s/venv' % env)
 
 
+@traced
 def deploy_cronjobs():
     """
     Deploy the app server cronjobs
     """
     notify('Deploying cronjobs')
-    with cd(env.code_dir):
+    with sudo_batch() as batch, cd(env.code_dir):
         # Replace variables in cron files
-        sudo("rename 's#BUILD#%(build)s#' deploy/cron.d/*" % env)
-        sudo("sed -i 's#VIRTUALENV_ROOT#%(virtualenv)s#g' deploy/cron.d/*" % env)
-        sudo("sed -i 's#BUILD_ROOT#%(code_dir)s#g' deploy/cron.d/*" % env)
-        sudo("sed -i 's#BUILD#%(build)s#g' deploy/cron.d/*" % env)
-        sudo("mv deploy/cron.d/* /etc/cron.d" % env)
+        batch.sudo("rename 's#BUILD#%(build)s#' deploy/cron.d/*" % env)
+        batch.sudo("sed -i 's#VIRTUALENV_ROOT#%(virtualenv)s#g' deploy/cron.d/*" % env)
+        batch.sudo("sed -i 's#BUILD_ROOT#%(code_dir)s#g' deploy/cron.d/*" % env)
+        batch.sudo("sed -i 's#BUILD#%(build)s#g' deploy/cron.d/*" % env)
+        batch.sudo("mv deploy/cron.d/* /etc/cron.d" % env)
 
 
-def restart_supervisord_services():
+def wait_for_health(url, timeout=60):
+    """
+    Poll *url* on the remote host until it responds successfully or abort
+    after *timeout* seconds.
+    """
+    with settings(warn_only=True):
+        result = sudo(
+            'for i in $(seq {timeout}); do '
+            'curl -fsS -o /dev/null --max-time 2 "{url}" && exit 0; '
+            'sleep 1; done; exit 1'.format(url=url, timeout=timeout))
+    if result.failed:
+        abort('{} did not become healthy within {} seconds'.format(
+            url, timeout))
+
+
+@traced
+def restart_supervisord_services(rolling=False, health_url=None, timeout=60):
+    """
+    Restart the supervisor processes of ``env.supervisor_proc`` and
+    ``env.celery_proc``.
+
+    With *rolling* the processes are restarted one after the other. Before
+    the web process is restarted, ``env.drain_command`` is run to take the
+    host out of rotation and the requests it is still serving are given
+    ``env.drain_grace`` seconds to finish. After restarting it,
+    *health_url* (defaults to ``env.health_check_url``) is polled for up
+    to *timeout* seconds and ``env.undrain_command`` is run to put the host
+    back. A host failing its health check stays out of rotation.
+
+    Supervisor stops each process with its ``stopsignal`` and kills it
+    after ``stopwaitsecs``. Celery workers only finish their running tasks
+    (a warm shutdown) if ``stopwaitsecs`` is long enough for them.
+    """
     services = [env.supervisor_proc]
     if hasattr(env, 'celery_proc') and env.celery_proc:
         services.append(env.celery_proc)
-    sudo('supervisorctl restart {}'.format(' '.join(services)))
+
+    if not rolling:
+        sudo('supervisorctl restart {}'.format(' '.join(services)))
+        return
+
+    health_url = health_url or env.get('health_check_url')
+    for service in services:
+        if service != env.supervisor_proc:
+            sudo('supervisorctl restart {}'.format(service))
+            continue
+
+        if env.get('drain_command'):
+            notify('Draining {}'.format(env.host_string))
+            sudo(env.drain_command)
+        if env.get('drain_grace'):
+            time.sleep(env.drain_grace)
+        sudo('supervisorctl restart {}'.format(service))
+        if health_url:
+            wait_for_health(health_url, timeout=timeout)
+        if env.get('undrain_command'):
+            sudo(env.undrain_command)
+
+
+def _retarget_symlink(build_dir):
+    """
+    Point the symlink of ``env.build`` to *build_dir*, replacing the old
+    link in a single rename so that there is no moment without it.
+    """
+    with cd(env.builds_dir):
+        sudo('ln -sfn {0} .{1}.tmp && mv -T .{1}.tmp {1}'.format(
+            build_dir, env.build))
+    clear_host_facts()
 
 
+@traced
 def switch_symlink():
     notify("Switching symlinks")
-    with cd(env.builds_dir):
-        # Create new symlink for build folder
-        sudo('if [ -h %(build)s ]; then unlink %(build)s; fi' % env)
-        sudo('ln -s %(build_dir)s %(build)s' % env)
+    _retarget_symlink(env.build_dir)
 
 
+def list_builds():
+    """
+    Return the retained builds of ``env.build``, newest first, as
+    dictionaries with the ``name`` of the build directory, the ``refspec``
+    and ``user`` from its ``build-info``, whether it is the ``current``
+    build and the ``virtualenv`` linked from it, if any.
+    """
+    output = sudo(
+        'for dir in {0.builds_dir}/{0.build}-*/; do '
+        'if [ -f "$dir/build-info" ]; then '
+        'echo "--- $(basename "$dir") $(readlink -e "$dir/venv")"; '
+        'cat "$dir/build-info"; fi; done'.format(env))
+    current = get_host_facts()['current_build']
+
+    builds = []
+    for line in output.splitlines():
+        if line.startswith('--- '):
+            parts = line.split()[1:]
+            builds.append({'name': parts[0], 'current': parts[0] == current,
+                           'virtualenv': parts[1] if len(parts) > 1 else None,
+                           'refspec': None, 'user': None})
+        elif builds and ': ' in line:
+            key, value = line.split(': ', 1)
+            if key in ('refspec', 'user'):
+                builds[-1][key] = value.strip()
+    return sorted(builds, key=lambda build: build['name'], reverse=True)
+
+
+def show_builds():
+    """ Print the retained builds of ``env.build`` """
+    for build in list_builds():
+        print '{} {:<30} {:<42} {}'.format(
+            '*' if build['current'] else ' ', build['name'],
+            build['refspec'] or '-', build['user'] or '-')
+
+
+@traced
+def rollback(build_dir=None, restart=True, rolling=False, health_url=None):
+    """
+    Switch the symlink back to the retained build *build_dir*, by default
+    the newest build older than the current one, and restart the
+    services.
+
+    If the build links its own virtualenv as ``venv`` (see
+    ``update_virtualenv(keyed_by_hash=True)``) ``env.virtualenv`` is
+    pointed to it. Otherwise the shared virtualenv keeps the packages of
+    the current build.
+    """
+    builds = list_builds()
+    names = [build['name'] for build in builds]
+    current = [build['name'] for build in builds if build['current']]
+
+    if build_dir is None:
+        older = [name for name in names if current and name < current[0]]
+        if not older:
+            abort('There is no retained build to roll back to.')
+        build_dir = older[0]
+    elif build_dir not in names:
+        abort('Build {} is not retained, choose one of: {}'.format(
+            build_dir, ', '.join(names)))
+
+    build = builds[names.index(build_dir)]
+    notify('Rolling back to {name} (refspec {refspec})'.format(**build))
+    if build['virtualenv']:
+        env.virtualenv = build['virtualenv']
+    else:
+        print 'Build {} has no own virtualenv, keeping {}'.format(
+            build_dir, env.virtualenv)
+
+    env.build_dir = build_dir
+    env.code_dir = '{}/{}'.format(env.builds_dir, build_dir)
+    _retarget_symlink(build_dir)
+
+    if restart:
+        restart_supervisord_services(rolling=rolling, health_url=health_url)
+
+
+@traced
 def upload(local_path, remote_path=None):
     """
     Uploads a file
@@ -98,82 +505,281 @@ def upload(local_path, remote_path=None):
     put(local_path, remote_path)
 
 
-def unpack(archive_path):
+def _extract_command(archive_path):
+    """ Return the tar command to extract *archive_path* based on its type """
+    if archive_path.endswith('.zst'):
+        return 'tar --use-compress-program=unzstd -xf {}'.format(archive_path)
+    return 'tar xzf {}'.format(archive_path)
+
+
+def get_deployed_refspec():
     """
-    Unpacks the tarball into the correct place but doesn't switch
-    the symlink
+    Return the refspec of the build the symlink points to or ``None``
     """
-    # Ensure all folders are in place
-    sudo('if [ ! -d "{env.builds_dir}" ]; then mkdir -p "{env.builds_dir}";'
-         ' fi'.format(env=env))
+    output = sudo('cat "$(readlink -f {}/{})/build-info" 2>/dev/null || '
+                  'true'.format(env.builds_dir, env.build))
+    for line in output.splitlines():
+        if line.startswith('refspec: '):
+            return line.split(': ', 1)[1].strip()
+    return None
 
-    notify("Creating remote build folder")
-    with cd(env.builds_dir):
-        sudo('tar xzf %s' % archive_path)
 
-        # Create new build folder
-        sudo('if [ -d "%(build_dir)s" ]; then rm -rf "%(build_dir)s"; fi' % env)
-        sudo('mv %(web_dir)s %(build_dir)s' % env)
-
-        # Symlink in uploads folder
-        sudo('if [ ! -d "%(build_dir)s/public" ]; then mkdir -p "%(build_dir)s/public"; fi' % env)
-        sudo('ln -s %(project_dir)s/media/%(build)s %(build_dir)s/public/media' % env)
+@traced
+def unpack(archive_path, link_unchanged=False):
+    """
+    Unpacks the tarball into the correct place but doesn't switch
+    the symlink
 
-        # Add file indicating Git commit
-        sudo('echo -e "refspec: %s\nuser: %s" > %s/build-info' % (env.version, env.user, env.build_dir))
+    With *link_unchanged* the new build is compared against the build the
+    symlink currently points to and files with identical content and mode
+    are replaced by hard links to the existing copies, so that they are
+    not stored again. Linked files are shared between builds, so they must
+    not be modified in place after unpacking.
 
-        # Remove archive
-        sudo('rm %s' % archive_path)
+    Patch archives (see ``prepare(base=...)``) are applied on top of a
+    copy of the current build, which has to be the one they were built
+    against. With *link_unchanged* the copy hard links all files.
+    """
+    with sudo_batch() as batch:
+        # Ensure all folders are in place
+        batch.sudo('if [ ! -d "{env.builds_dir}" ]; then '
+                   'mkdir -p "{env.builds_dir}"; fi'.format(env=env))
+
+        notify("Creating remote build folder")
+        with cd(env.builds_dir):
+            # Leftovers of an interrupted unpack would be merged into the build
+            batch.sudo('rm -rf %(web_dir)s .staging-%(build_dir)s' % env)
+            batch.sudo(_extract_command(archive_path))
+
+            # Create new build folder
+            batch.sudo('if [ -d "%(build_dir)s" ]; then rm -rf "%(build_dir)s"; fi' % env)
+            if env.get('build_base'):
+                batch.sudo(
+                    'current=$(readlink -f %(build)s); '
+                    'grep -qxF "refspec: $(cat %(web_dir)s/.fluffy-patch)" '
+                    '"$current/build-info" || { echo "The current build is '
+                    'not the base of this patch"; exit 1; }' % env)
+                batch.sudo('cp -a%s "$(readlink -f %s)" %s' % (
+                    'l' if link_unchanged else '', env.build, env.build_dir))
+                batch.sudo('cd %(build_dir)s && xargs -0 -r rm -f -- '
+                           '< ../%(web_dir)s/.fluffy-deleted' % env)
+                batch.sudo('rm %(web_dir)s/.fluffy-patch '
+                           '%(web_dir)s/.fluffy-deleted' % env)
+                # Replace rather than overwrite files, they may be linked
+                batch.sudo('cp -a --remove-destination %(web_dir)s/. '
+                           '%(build_dir)s/ && rm -rf %(web_dir)s' % env)
+            elif link_unchanged:
+                batch.sudo('mv %(web_dir)s %(build_dir)s' % env)
+                batch.sudo(
+                    'current=$(readlink -f %(build)s); '
+                    'if [ -d "$current" ]; then cd %(build_dir)s && '
+                    'find . -type f -print0 | '
+                    'while IFS= read -r -d "" f; do '
+                    'if cmp -s "$f" "$current/$f" && '
+                    '[ "$(stat -c %%a:%%u:%%g "$f")" = '
+                    '"$(stat -c %%a:%%u:%%g "$current/$f")" ]; then '
+                    'ln -f "$current/$f" "$f"; fi; done; fi' % env)
+            else:
+                batch.sudo('mv %(web_dir)s %(build_dir)s' % env)
+
+            # Symlink in uploads folder
+            batch.sudo('if [ ! -d "%(build_dir)s/public" ]; then mkdir -p "%(build_dir)s/public"; fi' % env)
+            batch.sudo('ln -sfn %(project_dir)s/media/%(build)s %(build_dir)s/public/media' % env)
+
+            # Add file indicating Git commit, which may be hard linked to
+            # the one of the previous build
+            batch.sudo('rm -f %s/build-info' % env.build_dir)
+            batch.sudo('echo -e "refspec: %s\nuser: %s" > %s/build-info' % (env.version, env.user, env.build_dir))
+
+            # Remove archive
+            batch.sudo('rm %s' % archive_path)
+    clear_host_facts()
+
+
+@traced
+def unpack_wheelhouse(archive_path, wheelhouse='wheelhouse'):
+    """
+    Unpack the wheelhouse built by :func:`fluffy.prepare.build_wheelhouse`
+    into the *wheelhouse* directory of the new build.
+    """
+    notify('Unpacking wheelhouse')
+    with cd(env.code_dir):
+        sudo('mkdir -p {0} && tar xzf {1} -C {0} && rm {1}'.format(
+            wheelhouse, archive_path))
 
 
+@traced
 def deploy_codebase(archive_file, commit_id):
     """
-    Push a tarball of the codebase up
+    Push a tarball of the codebase up, together with the wheelhouse if one
+    was built.
     """
     upload(archive_file)
     unpack(archive_file)
 
+    if env.get('wheelhouse_file'):
+        upload(env.wheelhouse_file)
+        unpack_wheelhouse(env.wheelhouse_file)
+
 
+@traced
 def initialise_project():
     """
     Create initial project/build folder structure on remote machine
     """
-    if not exists(env.code_dir):
+    if env.code_dir not in get_host_facts()['dirs']:
         notify('Setting up remote project structure for %(build)s build' % env)
-        sudo('mkdir -p %(project_dir)s' % env)
-        with cd(env.project_dir):
-            sudo('mkdir -p builds')
-            sudo('mkdir -p data/%(build)s' % env)
-            sudo('mkdir -p logs/%(build)s' % env)
-            sudo('mkdir -p media/%(build)s' % env)
-            sudo('mkdir -p run/%(build)s' % env)
-            sudo('mkdir -p virtualenvs/%(build)s' % env)
-
-            sudo('`which virtualenv` --no-site-packages %(project_dir)s/virtualenvs/%(build)s/' % env)
-            sudo('echo "export DJANGO_CONF=\"conf.%(build)s\"" >> virtualenvs/%(build)s/bin/activate' % env)
-        with cd('%(project_dir)s/builds/' % env):
-            # Create directory and symlink for "zero" build
-            sudo('mkdir %(build)s-0' % env)
-            sudo('ln -s %(build)s-0 %(build)s' % env)
+        with sudo_batch() as batch:
+            batch.sudo('mkdir -p %(project_dir)s' % env)
+            with cd(env.project_dir):
+                batch.sudo('mkdir -p builds')
+                batch.sudo('mkdir -p data/%(build)s' % env)
+                batch.sudo('mkdir -p logs/%(build)s' % env)
+                batch.sudo('mkdir -p media/%(build)s' % env)
+                batch.sudo('mkdir -p run/%(build)s' % env)
+                batch.sudo('mkdir -p virtualenvs/%(build)s' % env)
+
+                batch.sudo('`which virtualenv` --no-site-packages %(project_dir)s/virtualenvs/%(build)s/' % env)
+                batch.sudo('echo "export DJANGO_CONF=\"conf.%(build)s\"" >> virtualenvs/%(build)s/bin/activate' % env)
+            with cd('%(project_dir)s/builds/' % env):
+                # Create directory and symlink for "zero" build
+                batch.sudo('mkdir %(build)s-0' % env)
+                batch.sudo('ln -s %(build)s-0 %(build)s' % env)
+        clear_host_facts()
         notify('Remote project structure created')
     else:
         notify('Remote directory for {build} build already exists, '
                'skipping'.format(**env))
 
 
+# Compiled templates by path and modification time, and their renderings
+_templates = {}
+_renderings = {}
+_missing = object()
+
+
+class _RecordingEnv(object):
+    """
+    Proxy for ``env`` that records which of its keys a template reads, so
+    a rendering can be reused for every host on which those keys have the
+    same values.
+    """
+    def __init__(self):
+        self.used = {}
+        # Cleared when the template looked at all of env, e.g. by iterating
+        self.cacheable = True
+
+    def _record(self, name):
+        value = env.get(name, _missing)
+        self.used[name] = repr(value)
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = self._record(name)
+        if value is _missing:
+            raise AttributeError(name)
+        return value
+
+    def __getitem__(self, name):
+        value = self._record(name)
+        if value is _missing:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self._record(name) is not _missing
+
+    def get(self, name, default=None):
+        value = self._record(name)
+        return default if value is _missing else value
+
+    def _all(self):
+        self.cacheable = False
+        return env
+
+    def keys(self):
+        return self._all().keys()
+
+    def values(self):
+        return self._all().values()
+
+    def items(self):
+        return self._all().items()
+
+    def __iter__(self):
+        return iter(self._all())
+
+    def __len__(self):
+        return len(self._all())
+
+
+def _get_template(template_name):
+    from jinja2 import Template
+
+    key = (os.path.abspath(template_name), os.path.getmtime(template_name))
+    if key not in _templates:
+        with open(template_name) as fh:
+            _templates[key] = Template(fh.read())
+    return key, _templates[key]
+
+
+def render_template(template_name, context=None):
+    """
+    Render the jinja template *template_name* with *context* or, without a
+    context, with ``env``. Templates are compiled once and a rendering is
+    reused as long as the context (or the ``env`` keys the template used)
+    did not change.
+    """
+    key, template = _get_template(template_name)
+
+    if context:
+        render_key = (key, repr(sorted(context.items())))
+        if render_key not in _renderings:
+            _renderings[render_key] = template.render(**context)
+        return _renderings[render_key]
+
+    renderings = _renderings.setdefault((key, None), [])
+    for used, content in renderings:
+        if all(repr(env.get(name, _missing)) == value
+               for name, value in used.items()):
+            return content
+
+    recorder = _RecordingEnv()
+    content = template.render(env=recorder)
+    if recorder.cacheable:
+        renderings.append((recorder.used, content))
+    return content
+
+
+def _checksum(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def _get_remote_checksums(paths):
+    """ Return the SHA1 of each of the existing remote files in *paths* """
+    output = sudo('sha1sum {} 2>/dev/null || true'.format(' '.join(paths)))
+    return dict(reversed(line.split(None, 1)) for line in output.splitlines()
+                if line.strip())
+
+
+@traced
 def upload_template(template_name, remote_path, owner=None, group=None,
                     context= None, **kwargs):
     """
     Render the jinja template *template_name* and upload it to *remote_path*.
+
+    Nothing is uploaded if the remote file already has the same content.
     """
+    content = render_template(template_name, context)
 
-    with open(template_name) as fh:
-        template = Template(fh.read())
-
-    if context:
-        content = template.render(**context)
-    else:
-        content = template.render(env=env)
+    checksums = _get_remote_checksums([remote_path])
+    if checksums.get(remote_path) == _checksum(content):
+        notify('{} is up to date'.format(remote_path))
+        return
 
     put_kwargs = {'temp_dir': '/tmp', 'mode': '0644'}
     put_kwargs.update(kwargs)
@@ -183,5 +789,55 @@ def upload_template(template_name, remote_path, owner=None, group=None,
         if group:
             owner = "{}:{}".format(owner, group)
         sudo(u'chown {} {}'.format(owner, remote_path))
-    else:
+    elif group:
         sudo(u'chgrp {} {}'.format(group, remote_path))
+
+
+@traced
+def upload_templates(templates, mode='0644'):
+    """
+    Render and upload several templates in a single transfer. *templates*
+    is a list of dictionaries with the keys ``template_name`` and
+    ``remote_path`` and optionally ``owner``, ``group`` and ``context`` as
+    for :func:`upload_template`. Only files whose remote content differs
+    are uploaded, and they are installed with one remote command.
+    """
+    rendered = []
+    for spec in templates:
+        content = render_template(spec['template_name'], spec.get('context'))
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        rendered.append((spec, content))
+
+    checksums = _get_remote_checksums(
+        [spec['remote_path'] for spec, _ in rendered])
+    changed = [(spec, content) for spec, content in rendered
+               if checksums.get(spec['remote_path']) != _checksum(content)]
+    if not changed:
+        notify('All {} templates are up to date'.format(len(rendered)))
+        return
+
+    notify('Uploading {} of {} templates'.format(len(changed), len(rendered)))
+    archive = StringIO()
+    with contextlib.closing(tarfile.open(fileobj=archive, mode='w:gz')) as tar:
+        for idx, (_, content) in enumerate(changed):
+            info = tarfile.TarInfo(str(idx))
+            info.size = len(content)
+            info.mtime = time.time()
+            tar.addfile(info, StringIO(content))
+    archive.seek(0)
+
+    archive_path = '/tmp/fluffy-templates-{}.tar.gz'.format(uuid.uuid4().hex)
+    put(archive, archive_path)
+
+    commands = ['t=$(mktemp -d)', 'tar xzf {} -C "$t"'.format(archive_path)]
+    for idx, (spec, _) in enumerate(changed):
+        options = ['-m {}'.format(mode)]
+        if spec.get('owner'):
+            options.append('-o {}'.format(spec['owner']))
+        if spec.get('group'):
+            options.append('-g {}'.format(spec['group']))
+        commands.append('install {} "$t/{}" {}'.format(
+            ' '.join(options), idx, spec['remote_path']))
+    sudo(' && '.join(commands) + '; rc=$?; rm -rf "$t" {}; exit $rc'.format(
+        archive_path))
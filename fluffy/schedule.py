@@ -0,0 +1,197 @@
+"""
+Run the steps of a deployment on one host as a graph, starting each step
+as soon as the steps it depends on have finished::
+
+    run_graph([
+        Step(unpack, (env.build_file,), provides=['code']),
+        Step(update_virtualenv, requires=['code'], provides=['virtualenv']),
+        Step(deploy_cronjobs, requires=['code']),
+        Step(switch_symlink, requires=['code', 'virtualenv']),
+    ])
+
+Independent steps run concurrently, each in a forked process with its own
+connection to the host, in the same way Fabric runs parallel tasks. A
+graph can be run on many hosts with
+``orchestrate.run_in_batches([(run_graph, (steps,))])``.
+"""
+from __future__ import absolute_import
+
+import time
+import multiprocessing
+
+from fabric import state
+from fabric.api import env
+from fabric.utils import abort
+
+from . import trace
+from .output import notify
+
+
+class Step(object):
+    """
+    A step of a graph run by :func:`run_graph`.
+
+    *requires* and *provides* name the resources the step consumes and
+    produces, e.g. ``'code'`` or ``'virtualenv'``. Provided names that are
+    keys of ``env`` after the step ran are copied back into the ``env`` of
+    the scheduler, so that later steps see them.
+    """
+
+    def __init__(self, func, args=(), kwargs=None, requires=(), provides=(),
+                 name=None):
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.requires = tuple(requires)
+        self.provides = tuple(provides)
+        self.name = name or getattr(func, '__name__', repr(func))
+
+
+def _dependencies(steps):
+    """ Map each step name to the names of the steps it depends on """
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        abort('Step names must be unique: {}'.format(', '.join(names)))
+
+    providers = {}
+    for step in steps:
+        for resource in step.provides:
+            if resource in providers:
+                abort("'{}' is provided by both {} and {}".format(
+                    resource, providers[resource], step.name))
+            providers[resource] = step.name
+
+    dependencies = {}
+    for step in steps:
+        missing = [r for r in step.requires if r not in providers]
+        if missing:
+            abort("Step {} requires {} which no step provides".format(
+                step.name, ', '.join(missing)))
+        dependencies[step.name] = set(providers[r] for r in step.requires)
+
+    done = set()
+    while len(done) < len(names):
+        ready = [n for n in names if n not in done and
+                 dependencies[n] <= done]
+        if not ready:
+            abort('The steps {} depend on each other'.format(
+                ', '.join(n for n in names if n not in done)))
+        done.update(ready)
+    return dependencies
+
+
+def _run_step(step, conn):
+    """ Run *step* in a forked process and send its result over *conn* """
+    state.connections.clear()
+    env.linewise = True
+    since = trace.mark()
+    result = {'ok': True, 'error': None, 'env': {}}
+    try:
+        step.func(*step.args, **step.kwargs)
+        result['env'] = dict((key, env[key]) for key in step.provides
+                             if key in env)
+    except (Exception, SystemExit) as exc:
+        result = {'ok': False, 'error': str(exc) or exc.__class__.__name__,
+                  'env': {}}
+    result['events'] = trace.take_events(since)
+    conn.send(result)
+    conn.close()
+
+
+def _critical_path(dependencies, timings):
+    """ Return the chain of steps with the longest total duration """
+    length, previous = {}, {}
+    for name in sorted(timings, key=lambda n: timings[n]['end']):
+        before = max(dependencies[name], key=lambda n: length[n]) \
+            if dependencies[name] else None
+        previous[name] = before
+        length[name] = timings[name]['duration'] + \
+            (length[before] if before else 0)
+
+    path = []
+    name = max(length, key=length.get) if length else None
+    while name:
+        path.insert(0, name)
+        name = previous[name]
+    return path
+
+
+def run_graph(steps, max_workers=None):
+    """
+    Run *steps* on the current host with up to *max_workers* of them
+    (``env.graph_workers``, all by default) at a time, each as soon as
+    the steps providing its requirements finished.
+
+    Once a step failed no further steps are started and the run is
+    aborted after the running ones finished. Returns a dictionary with the
+    ``timings`` of each step, the ``critical_path`` of step names that
+    determined the total time and the ``wall_time``.
+    """
+    dependencies = _dependencies(steps)
+    max_workers = int(max_workers or env.get('graph_workers') or len(steps))
+
+    pending = list(steps)
+    running = {}
+    timings = {}
+    failures = []
+    started = time.time()
+    while pending or running:
+        finished = set(timings)
+        ready = [s for s in pending if dependencies[s.name] <= finished]
+        while ready and not failures and len(running) < max_workers:
+            step = ready.pop(0)
+            pending.remove(step)
+            receiver, sender = multiprocessing.Pipe(False)
+            process = multiprocessing.Process(target=_run_step,
+                                              args=(step, sender))
+            process.name = step.name
+            process.start()
+            sender.close()
+            running[step.name] = (process, receiver, time.time())
+
+        if not running:
+            break
+
+        progressed = False
+        for name, (process, receiver, start) in running.items():
+            # Checked before polling, the step may send its result and exit
+            # in between
+            alive = process.is_alive()
+            result = None
+            if receiver.poll():
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    pass
+            elif alive:
+                continue
+
+            progressed = True
+            process.join()
+            if result is None:
+                result = {'ok': False, 'env': {}, 'events': [],
+                          'error': 'exited with {}'.format(process.exitcode)}
+            del running[name]
+            end = time.time()
+            trace.add_events(result['events'])
+            if not result['ok']:
+                failures.append((name, result['error']))
+                continue
+            env.update(result['env'])
+            timings[name] = {'start': start - started, 'end': end - started,
+                             'duration': end - start}
+
+        if not progressed:
+            time.sleep(0.05)
+
+    if failures:
+        abort('Step(s) failed: {}'.format('; '.join(
+            '{}: {}'.format(name, error) for name, error in failures)))
+
+    wall_time = time.time() - started
+    path = _critical_path(dependencies, timings)
+    notify('Critical path: {} ({:.1f}s of {:.1f}s)'.format(
+        ' -> '.join('{} ({:.1f}s)'.format(n, timings[n]['duration'])
+                    for n in path),
+        sum(timings[n]['duration'] for n in path), wall_time))
+    return {'timings': timings, 'critical_path': path, 'wall_time': wall_time}
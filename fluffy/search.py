@@ -1,17 +1,53 @@
 from __future__ import absolute_import
 
-from fabric.api import env, sudo, cd
+from fabric.api import env, cd
 
+from .trace import traced
 from .output import notify
 from .remote import venv_sudo
+from .operations import sudo
 
 
-def deploy_solr():
+def _get_changed_solr_files():
+    """
+    Return the files in ``deploy/solr`` of the new build that differ from
+    the ones installed in ``env.solr_dir``.
+    """
+    with cd(env.code_dir):
+        changed = sudo(
+            'cd deploy/solr && find . -type f | while read f; do '
+            'cmp -s "$f" "%(solr_dir)s/conf/$f" || echo "$f"; done' % env)
+    return changed.split()
+
+
+@traced
+def deploy_solr(force=False, workers=None, age=None):
     """
     Create new schema.xml for Solr through haystack and restart solr.
+
+    Solr is only reconfigured, restarted and its index rebuilt if the
+    configuration in ``deploy/solr`` changed or *force* is ``True``.
+    Otherwise the index is updated in place using *workers* processes
+    (``env.solr_update_workers``) and, if *age* is given
+    (``env.solr_update_age``), only for objects changed in the last *age*
+    hours.
     """
-    notify('Update SOLR indexes')
+    changed = _get_changed_solr_files()
+    if changed or force:
+        notify('Update SOLR configuration and rebuild indexes')
+        with cd(env.code_dir):
+            sudo("cp -rf deploy/solr/* %(solr_dir)s/conf" % env)
+            sudo('service tomcat6 restart')
+            venv_sudo('./manage.py rebuild_index --noinput')
+        return
+
+    notify('SOLR configuration unchanged, updating indexes')
+    options = []
+    workers = workers or env.get('solr_update_workers')
+    if workers:
+        options.append('--workers={}'.format(workers))
+    age = age or env.get('solr_update_age')
+    if age:
+        options.append('--age={}'.format(age))
     with cd(env.code_dir):
-        sudo("cp -rf deploy/solr/* %(solr_dir)s/conf" % env)
-        sudo('service tomcat6 restart')
-        venv_sudo('source %s/bin/activate && ./manage.py rebuild_index')
+        venv_sudo('./manage.py update_index {}'.format(' '.join(options)))
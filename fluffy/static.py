@@ -0,0 +1,120 @@
+"""
+Content-hashed manifests of collected static files.
+
+The manifest maps each file below the static root to the SHA1 of its
+content. It is written after static files were collected locally and
+shipped with the build, which tells remote hosts that the static files
+are already in place. It is also used to only precompress files that
+changed since the last build.
+"""
+from __future__ import absolute_import
+
+import os
+import gzip
+import json
+import hashlib
+import multiprocessing
+
+MANIFEST_NAME = '.fluffy-manifest.json'
+PRECOMPRESSED_MANIFEST_NAME = '.fluffy-precompressed.json'
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.map', '.json', '.svg', '.html',
+                           '.txt', '.xml', '.ttf', '.eot', '.otf', '.ico')
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(static_dir):
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, static_dir)
+            if name.startswith('.fluffy-') or os.path.islink(path):
+                continue
+            if name.endswith(('.gz', '.br')) and os.path.exists(path[:-3]):
+                # Precompressed sibling of another static file
+                continue
+            manifest[relpath] = file_hash(path)
+    return manifest
+
+
+def read_manifest(static_dir, name=MANIFEST_NAME):
+    try:
+        with open(os.path.join(static_dir, name)) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_manifest(static_dir, manifest, name=MANIFEST_NAME):
+    path = os.path.join(static_dir, name)
+    with open('{}.tmp'.format(path), 'w') as fh:
+        json.dump(manifest, fh, indent=0, sort_keys=True)
+    os.rename('{}.tmp'.format(path), path)
+
+
+def changed_files(old, new):
+    """ Return the files in manifest *new* that differ from *old* """
+    return sorted(path for path, digest in new.items()
+                  if old.get(path) != digest)
+
+
+def _compress(args):
+    path, use_brotli = args
+    with open(path, 'rb') as fh:
+        content = fh.read()
+
+    with open('{}.gz'.format(path), 'wb') as fh:
+        # A fixed mtime keeps the output identical for identical input
+        with gzip.GzipFile('', 'wb', 9, fh, mtime=0) as gz:
+            gz.write(content)
+
+    if use_brotli:
+        import brotli
+        with open('{}.br'.format(path), 'wb') as fh:
+            fh.write(brotli.compress(content))
+    return path
+
+
+def precompress(static_dir, use_brotli=False, processes=None, min_size=256):
+    """
+    Write ``.gz`` (and with *use_brotli* ``.br``) siblings for all
+    compressible files in *static_dir* of at least *min_size* bytes using a
+    pool of *processes* workers. Files whose content did not change since
+    the last run and whose siblings exist are skipped. Returns the list of
+    compressed files relative to *static_dir*.
+    """
+    manifest = build_manifest(static_dir)
+    done = read_manifest(static_dir, PRECOMPRESSED_MANIFEST_NAME)
+
+    compressible = {}
+    todo = []
+    for relpath, digest in manifest.items():
+        path = os.path.join(static_dir, relpath)
+        if (not relpath.lower().endswith(COMPRESSIBLE_EXTENSIONS) or
+                os.path.getsize(path) < min_size):
+            continue
+        compressible[relpath] = digest
+        siblings = ['.gz', '.br'] if use_brotli else ['.gz']
+        if done.get(relpath) != digest or not all(
+                os.path.exists(path + ext) for ext in siblings):
+            todo.append(relpath)
+
+    if todo:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_compress, [(os.path.join(static_dir, relpath),
+                                  use_brotli) for relpath in todo])
+        finally:
+            pool.close()
+            pool.join()
+
+    write_manifest(static_dir, compressible, PRECOMPRESSED_MANIFEST_NAME)
+    return sorted(todo)
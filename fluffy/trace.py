@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import functools
+import contextlib
+
+from fabric.api import env
+
+# Finished steps and the steps currently running in this process
+_events = []
+_active = []
+
+
+def _host():
+    return env.host_string or 'localhost'
+
+
+@contextlib.contextmanager
+def step(name):
+    """
+    Record wall time, bytes transferred and remote commands issued while
+    the block runs as a step called *name* on the current host.
+    """
+    event = {'name': name, 'host': _host(), 'start': time.time(),
+             'duration': None, 'bytes': 0, 'commands': 0}
+    _active.append(event)
+    try:
+        yield event
+    finally:
+        _active.remove(event)
+        event['duration'] = time.time() - event['start']
+        _events.append(event)
+
+
+def traced(func):
+    """ Decorator recording each call of *func* as a :func:`step` """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with step(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def record_command(count=1):
+    for event in _active:
+        event['commands'] += count
+
+
+def record_bytes(size):
+    for event in _active:
+        event['bytes'] += size
+
+
+def mark():
+    """ Return a marker for :func:`take_events` """
+    return len(_events)
+
+
+def take_events(since=0):
+    """
+    Remove and return the events recorded after marker *since*. Used to
+    hand events from parallel workers back to the main process.
+    """
+    events = _events[since:]
+    del _events[since:]
+    return events
+
+
+def add_events(events):
+    _events.extend(events)
+
+
+def get_events():
+    return list(_events)
+
+
+def clear():
+    del _events[:]
+
+
+def _write(path, content):
+    """ Write *content* to *path* atomically """
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        fh.write(content)
+    os.rename(tmp_path, path)
+
+
+def write_json(path):
+    _write(path, json.dumps({'events': get_events()}, indent=2))
+
+
+def write_chrome_trace(path):
+    """
+    Write the recorded steps in the Chrome trace event format, with one
+    process per host, for ``chrome://tracing`` or Perfetto.
+    """
+    events = get_events()
+    hosts = sorted(set(e['host'] for e in events))
+    trace_events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+         'args': {'name': host}} for pid, host in enumerate(hosts)]
+    for event in events:
+        trace_events.append({
+            'name': event['name'],
+            'ph': 'X',
+            'pid': hosts.index(event['host']),
+            'tid': 0,
+            'ts': int(event['start'] * 1e6),
+            'dur': int(event['duration'] * 1e6),
+            'args': {'bytes': event['bytes'],
+                     'commands': event['commands']},
+        })
+    _write(path, json.dumps({'traceEvents': trace_events}))
+
+
+def write_prometheus(path):
+    """
+    Write the totals per step and host in the Prometheus text format for
+    the node exporter's textfile collector.
+    """
+    totals = {}
+    for event in get_events():
+        total = totals.setdefault((event['name'], event['host']),
+                                  {'duration': 0, 'bytes': 0, 'commands': 0})
+        for key in total:
+            total[key] += event[key]
+
+    metrics = [
+        ('duration', 'fluffy_step_duration_seconds',
+         'Wall time spent in a deployment step.'),
+        ('bytes', 'fluffy_step_transferred_bytes',
+         'Bytes uploaded during a deployment step.'),
+        ('commands', 'fluffy_step_remote_commands',
+         'Remote commands issued during a deployment step.'),
+    ]
+    lines = []
+    for key, metric, doc in metrics:
+        lines.append('# HELP {} {}'.format(metric, doc))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for (name, host), total in sorted(totals.items()):
+            lines.append('{}{{step="{}",host="{}"}} {}'.format(
+                metric, name, host, total[key]))
+    _write(path, '\n'.join(lines) + '\n')
@@ -0,0 +1,34 @@
+import pytest
+
+from fabric.api import env
+from fabric.state import output
+
+from fluffy import trace
+
+
+@pytest.fixture
+def local_env(tmpdir):
+    """
+    Point fluffy at the local backend with a project in a scratch
+    directory and restore ``env`` afterwards.
+    """
+    saved = dict(env)
+    saved_output = dict(output)
+    project_dir = tmpdir.join('project')
+    env.update({
+        'fluffy_backend': 'local',
+        'host_string': 'local',
+        'build': 'test',
+        'user': 'test',
+        'project_dir': str(project_dir),
+        'builds_dir': str(project_dir.join('builds')),
+        'virtualenv': str(project_dir.join('virtualenvs', 'test')),
+        'code_dir': str(project_dir.join('builds', 'test')),
+    })
+    for name in ('running', 'stdout', 'status'):
+        output[name] = False
+    trace.clear()
+    yield tmpdir
+    env.clear()
+    env.update(saved)
+    output.update(saved_output)
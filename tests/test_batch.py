@@ -0,0 +1,18 @@
+import pytest
+
+from fluffy.remote import sudo_batch
+
+
+def test_batch_stops_at_failing_command(local_env, capsys):
+    marker = local_env.join('third')
+    with pytest.raises(SystemExit):
+        with sudo_batch() as batch:
+            batch.sudo('echo first-output')
+            batch.sudo('echo second-output; exit 3')
+            batch.sudo('touch {}'.format(marker))
+
+    message = capsys.readouterr().err.split('Fatal error: ')[-1]
+    assert ('Batched command 2 of 3 failed with exit code 3: '
+            'echo second-output; exit 3\nsecond-output') in message
+    assert 'first-output' not in message
+    assert not marker.check()
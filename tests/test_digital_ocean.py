@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from fabric.api import env
+
+from fluffy import digital_ocean
+
+
+class _Droplet(object):
+
+    def __init__(self, name, ip_address, region):
+        self.name = name
+        self.ip_address = ip_address
+        self.region = {'slug': region}
+
+
+class _Manager(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def get_all_droplets(self, **kwargs):
+        self.calls.append(kwargs)
+        return [_Droplet('web', '10.0.0.1', 'ams3'),
+                _Droplet('web', '10.0.0.2', 'fra1'),
+                _Droplet('worker', '10.0.0.3', 'ams3')]
+
+
+@pytest.fixture
+def manager(local_env, monkeypatch):
+    monkeypatch.setattr(digital_ocean, 'INVENTORY_CACHE_DIR',
+                        str(local_env.join('cache')))
+    env.update({'server_name_regex': None, 'server_format': None})
+    return _Manager()
+
+
+def test_inventory_is_cached_within_ttl(manager):
+    roles = digital_ocean.get_roles('client', manager=manager, cache_ttl=60)
+    assert digital_ocean.get_roles('client', manager=manager,
+                                   cache_ttl=60) == roles
+    assert roles == {'web': ['10.0.0.1:22', '10.0.0.2:22'],
+                     'worker': ['10.0.0.3:22']}
+    assert len(manager.calls) == 1
+
+
+def test_expired_inventory_is_fetched_again(manager):
+    digital_ocean.get_roles('client', manager=manager, cache_ttl=60)
+    path = digital_ocean._inventory_cache_path('client')
+    os.utime(path, (0, 0))
+
+    digital_ocean.get_roles('client', manager=manager, cache_ttl=60)
+    assert len(manager.calls) == 2
+
+
+def test_invalidated_inventory_is_fetched_again(manager):
+    digital_ocean.get_roles('client', manager=manager, cache_ttl=60)
+    digital_ocean.invalidate_inventory_cache()
+
+    digital_ocean.get_roles('client', manager=manager, cache_ttl=60)
+    assert len(manager.calls) == 2
+
+
+def test_tag_is_passed_to_the_api_and_cached_separately(manager):
+    digital_ocean.get_roles('client', manager=manager, cache_ttl=60)
+    digital_ocean.get_roles('client', manager=manager, cache_ttl=60,
+                            tag='production')
+    assert manager.calls == [{}, {'tag_name': 'production'}]
+
+
+def test_droplets_are_filtered_by_region(manager):
+    roles = digital_ocean.get_roles('client', manager=manager, cache_ttl=0,
+                                    region='ams3', ssh_port=2222)
+    assert roles == {'web': ['10.0.0.1:2222'], 'worker': ['10.0.0.3:2222']}
+    assert not os.path.exists(digital_ocean.INVENTORY_CACHE_DIR)
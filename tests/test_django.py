@@ -0,0 +1,23 @@
+from fabric.api import env
+
+from fluffy import django
+
+
+def test_migrate_keeps_lock_on_migrate_host(local_env, monkeypatch):
+    project = local_env.join('project')
+    project.join('builds', 'test', 'app', 'migrations', '0001.py').write(
+        '', ensure=True)
+    project.join('data', 'test').ensure(dir=True)
+    project.join('run', 'test').ensure(dir=True)
+    hosts = []
+    monkeypatch.setattr(django, 'run_manage',
+                        lambda command: hosts.append(env.host_string))
+    env.update({'host_string': 'web2', 'migrate_host': 'db',
+                'django_version': (1, 8)})
+
+    django.migrate()
+
+    assert hosts == ['db']
+    assert env.host_string == 'web2'
+    assert project.join('data', 'test', 'migrations.sha1').check()
+    assert not project.join('run', 'test', 'migrate.lock').check()
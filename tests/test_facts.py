@@ -0,0 +1,54 @@
+import os
+
+from fabric.api import env
+
+from fluffy import remote
+from fluffy.facts import get_host_facts, clear_host_facts
+
+
+def _make_builds(local_env, names):
+    local_env.join('project', 'virtualenvs').ensure(dir=True)
+    builds = local_env.join('project', 'builds')
+    for name in names:
+        builds.join(name).ensure(dir=True)
+    return builds
+
+
+def test_current_build_from_absolute_symlink(local_env):
+    builds = _make_builds(local_env, ['test-1', 'test-2'])
+    os.symlink(str(builds.join('test-1')), str(builds.join('test')))
+    clear_host_facts()
+
+    facts = get_host_facts()
+
+    assert facts['current_build'] == 'test-1'
+    assert [name for name, _ in facts['builds']] == ['test-2', 'test-1']
+    assert facts['free_kb'] > 0
+
+
+def test_delete_old_builds_keeps_absolutely_linked_build(local_env):
+    builds = _make_builds(local_env, ['test-1', 'test-2', 'test-3'])
+    os.symlink(str(builds.join('test-1')), str(builds.join('test')))
+    env.build_dir = 'test-3'
+    clear_host_facts()
+
+    remote.delete_old_builds(keep=0, background=False)
+
+    assert sorted(os.listdir(str(builds))) == [
+        '.trash', 'test', 'test-1', 'test-3']
+
+
+def test_delete_old_builds_without_free_space(local_env, monkeypatch):
+    monkeypatch.setattr(remote, 'get_host_facts', lambda: {
+        'builds': [('test-2', 0), ('test-1', 0)], 'current_build': 'test-2',
+        'free_kb': None})
+    discarded = []
+    monkeypatch.setattr(remote, '_discard',
+                        lambda victims, *args, **kwargs:
+                        discarded.extend(victims))
+    monkeypatch.setattr(remote, 'delete_unused_virtualenvs',
+                        lambda **kwargs: None)
+
+    remote.delete_old_builds(keep=5, min_free=1000)
+
+    assert discarded == []
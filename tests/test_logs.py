@@ -0,0 +1,36 @@
+from fabric.api import env, hide
+from fabric.state import output
+
+from fluffy import remote
+
+
+def test_venv_sudo_streams_to_host_log(local_env):
+    env.output_log_dir = str(local_env.join('logs'))
+    local_env.join('project', 'virtualenvs', 'test', 'bin',
+                   'activate').ensure()
+
+    with hide('stdout'):
+        result = remote.venv_sudo('echo hello')
+
+    assert result == 'hello'
+    assert 'hello' in local_env.join('logs', 'local.log').read()
+
+
+class _Result(str):
+    failed = False
+
+
+def test_venv_sudo_shows_output_for_fabric(local_env, monkeypatch):
+    env.output_log_dir = str(local_env.join('logs'))
+    calls = []
+
+    def sudo(command, **kwargs):
+        calls.append((output.stdout, output.stderr, kwargs['stdout']))
+        return _Result('')
+    monkeypatch.setattr(remote, 'sudo', sudo)
+
+    with hide('stdout', 'stderr'):
+        remote.venv_sudo('true')
+
+    assert calls[0][:2] == (True, True)
+    assert calls[0][2].path.endswith('local.log')
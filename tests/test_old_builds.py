@@ -0,0 +1,37 @@
+import pytest
+
+from fluffy.remote import _select_old_builds
+
+BUILDS = [('b5', 10), ('b4', 20), ('b3', 30), ('b2', 40), ('b1', 50)]
+SIZES = dict((name, 10) for name, _ in BUILDS)
+
+
+@pytest.mark.parametrize('protected, kwargs, expected', [
+    # Count
+    ((), {'keep': 2}, ['b3', 'b2', 'b1']),
+    ((), {'keep': 5}, []),
+    ((), {'keep': 10}, []),
+    (('b5',), {'keep': 0}, ['b4', 'b3', 'b2', 'b1']),
+    # Protected builds count towards keep but are never deleted
+    (('b1',), {'keep': 2}, ['b3', 'b2']),
+    (('b5',), {'keep': 2}, ['b3', 'b2', 'b1']),
+    # Age
+    ((), {'keep': 5, 'max_age': 35}, ['b2', 'b1']),
+    (('b1',), {'keep': 5, 'max_age': 35}, ['b2']),
+    ((), {'keep': 2, 'max_age': 100}, ['b3', 'b2', 'b1']),
+    # Free space already met
+    ((), {'keep': 5, 'min_free': 100, 'free': 200}, []),
+    ((), {'keep': 2, 'min_free': 100, 'free': 200}, ['b3', 'b2', 'b1']),
+    # Free space reached oldest first
+    ((), {'keep': 5, 'min_free': 100, 'free': 85}, ['b2', 'b1']),
+    (('b1',), {'keep': 5, 'min_free': 100, 'free': 95}, ['b2']),
+    # Builds deleted by the count already free space
+    ((), {'keep': 3, 'min_free': 100, 'free': 85}, ['b2', 'b1']),
+    # Free space that can't be reached deletes all unprotected builds
+    (('b5', 'b4'), {'keep': 5, 'min_free': 1000, 'free': 0},
+     ['b3', 'b2', 'b1']),
+])
+def test_select_old_builds(protected, kwargs, expected):
+    if 'min_free' in kwargs:
+        kwargs['sizes'] = SIZES
+    assert _select_old_builds(BUILDS, set(protected), **kwargs) == expected
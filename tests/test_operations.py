@@ -0,0 +1,56 @@
+import pytest
+
+from fabric.api import lcd, settings
+
+from fluffy import operations
+
+
+def test_put_resolves_local_path_in_lcd(local_env, monkeypatch):
+    local_env.join('src', 'build.tar.gz').write('in lcd', ensure=True)
+    local_env.join('build.tar.gz').write('in cwd')
+    monkeypatch.chdir(local_env)
+    uploads = []
+    monkeypatch.setattr(operations, 'is_local', lambda: False)
+    monkeypatch.setattr(operations, '_pooled_put',
+                        lambda local_path, remote_path, **kwargs:
+                        uploads.append(local_path))
+
+    with lcd(str(local_env.join('src'))):
+        operations.put('build.tar.gz', '/tmp/build.tar.gz')
+
+    assert uploads == [str(local_env.join('src', 'build.tar.gz'))]
+
+
+def test_local_put_resolves_local_path_in_lcd(local_env, monkeypatch):
+    local_env.join('src', 'build.tar.gz').write('in lcd', ensure=True)
+    monkeypatch.chdir(local_env)
+    target = str(local_env.join('uploaded.tar.gz'))
+
+    with lcd(str(local_env.join('src'))):
+        operations.put('build.tar.gz', target)
+
+    assert open(target).read() == 'in lcd'
+
+
+class _FailingSFTP(object):
+
+    def put(self, *args):
+        raise IOError('Permission denied')
+
+
+def test_pooled_put_warns_like_put(local_env, monkeypatch):
+    monkeypatch.setattr(operations, 'get_sftp', lambda: _FailingSFTP())
+
+    with settings(warn_only=True):
+        result = operations._pooled_put('build.tar.gz', '/tmp/build.tar.gz')
+
+    assert result == []
+    assert result.failed == ['build.tar.gz']
+    assert not result.succeeded
+
+
+def test_pooled_put_aborts_like_put(local_env, monkeypatch):
+    monkeypatch.setattr(operations, 'get_sftp', lambda: _FailingSFTP())
+
+    with pytest.raises(SystemExit):
+        operations._pooled_put('build.tar.gz', '/tmp/build.tar.gz')
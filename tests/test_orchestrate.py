@@ -0,0 +1,53 @@
+from fabric.api import env
+
+from fluffy import orchestrate
+from fluffy.operations import sudo
+from fluffy.orchestrate import run_in_batches
+from fluffy.remote import update_virtualenv
+
+
+def test_failing_command_marks_host_failed(local_env):
+    marker = local_env.join('after')
+
+    def after():
+        marker.write('x', mode='a')
+
+    results = run_in_batches([lambda: sudo('false'), after],
+                             hosts=['one', 'two'], pool_size=1,
+                             max_failures=2)
+
+    assert sorted(results) == ['one', 'two']
+    assert not any(result['ok'] for result in results.values())
+    assert not marker.check()
+
+
+def test_successful_steps_mark_host_ok(local_env):
+    results = run_in_batches([lambda: sudo('true')], hosts=['one'])
+
+    assert results['one']['ok']
+
+
+def _deploy_steps(monkeypatch, **kwargs):
+    captured = []
+    monkeypatch.setattr(orchestrate, 'run_in_batches',
+                        lambda steps, **kw: captured.extend(steps))
+    orchestrate.deploy(hosts=['one'], **kwargs)
+    return captured
+
+
+def test_deploy_installs_from_shipped_wheelhouse(local_env, monkeypatch):
+    env.update({'build_file': '/tmp/build.tar.gz', 'version': 'v1',
+                'wheelhouse_file': '/tmp/wheelhouse.tar.gz'})
+
+    steps = _deploy_steps(monkeypatch)
+
+    assert (update_virtualenv, (), {'wheelhouse': 'wheelhouse'}) in steps
+
+
+def test_deploy_without_wheelhouse_uses_index(local_env, monkeypatch):
+    env.update({'build_file': '/tmp/build.tar.gz', 'version': 'v1',
+                'wheelhouse_file': None})
+
+    steps = _deploy_steps(monkeypatch)
+
+    assert update_virtualenv in steps
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tarfile
+import subprocess
+
+import pytest
+
+from fabric.api import env
+
+from fluffy.prepare import build_wheelhouse, prepare, _stream_archive
+
+GIT = ['git', '-c', 'user.name=test', '-c', 'user.email=test@localhost']
+
+
+def _commit(repo, message):
+    subprocess.check_call(GIT + ['add', '-A', '.'], cwd=str(repo))
+    subprocess.check_call(GIT + ['commit', '-q', '-m', message],
+                          cwd=str(repo))
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=str(repo)).strip()
+
+
+def test_wheelhouse_uses_requirements_of_version(local_env, monkeypatch):
+    repo = local_env.join('repo')
+    requirements = repo.join('web', 'deploy', 'requirements').ensure(
+        dir=True)
+    requirements.join('test.txt').write('')
+    subprocess.check_call(['git', 'init', '-q', str(repo)])
+    subprocess.check_call(GIT + ['add', '.'], cwd=str(repo))
+    subprocess.check_call(GIT + ['commit', '-q', '-m', 'initial'],
+                          cwd=str(repo))
+    version = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd=str(repo)).strip()
+    tree = subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD:web/deploy/requirements'],
+        cwd=str(repo)).strip()
+
+    # Uncommitted requirements in the working tree must not be used
+    requirements.join('test.txt').write('fluffy-does-not-exist==0.0.0\n')
+    monkeypatch.chdir(repo)
+    env.update({'version': version, 'web_dir': 'web'})
+
+    try:
+        build_wheelhouse()
+        assert env.wheelhouse_file == '/tmp/wheelhouse-{}.tar.gz'.format(
+            tree[:12])
+        assert os.path.exists(env.wheelhouse_file)
+    finally:
+        if os.path.exists(env.wheelhouse_file):
+            os.remove(env.wheelhouse_file)
+        shutil.rmtree('/tmp/fluffy-wheelhouse-{}'.format(tree[:12]),
+                      ignore_errors=True)
+
+
+def test_patch_archive_ships_cron_files(local_env, monkeypatch):
+    repo = local_env.join('repo')
+    repo.join('web', 'app.py').write('v1', ensure=True)
+    repo.join('web', 'other.py').write('v1')
+    repo.join('web', 'deploy', 'cron.d', 'job').write('BUILD_ROOT',
+                                                     ensure=True)
+    subprocess.check_call(['git', 'init', '-q', str(repo)])
+    base = _commit(repo, 'initial')
+    repo.join('web', 'app.py').write('v2')
+    version = _commit(repo, 'change')
+
+    monkeypatch.chdir(repo)
+    env.update({'version': version, 'web_dir': 'web',
+                'django_version': (1, 8)})
+    prepare(use_cache=False, base=base)
+
+    try:
+        with tarfile.open(env.build_file) as archive:
+            names = sorted(archive.getnames())
+    finally:
+        os.remove(env.build_file)
+    assert names == ['web/.fluffy-deleted', 'web/.fluffy-patch',
+                     'web/app.py', 'web/deploy/cron.d/job']
+
+
+def test_stream_archive_aborts_when_git_archive_fails(local_env, monkeypatch,
+                                                      capsys):
+    repo = local_env.join('repo')
+    repo.join('web', 'app.py').write('', ensure=True)
+    subprocess.check_call(['git', 'init', '-q', str(repo)])
+    _commit(repo, 'initial')
+    monkeypatch.chdir(repo)
+    env.update({'version': 'does-not-exist', 'web_dir': 'web'})
+    build_file = str(local_env.join('build.tar.gz'))
+
+    with pytest.raises(SystemExit):
+        _stream_archive(build_file, [], 'gz')
+    assert 'return code 128' in capsys.readouterr().err
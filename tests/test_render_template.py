@@ -0,0 +1,39 @@
+from fabric.api import env
+
+from fluffy.remote import render_template
+
+
+def _render(tmpdir, source):
+    template = tmpdir.join('template.txt')
+    template.write(source)
+    return render_template(str(template))
+
+
+def test_env_get_with_default(local_env):
+    assert _render(local_env, "{{ env.get('fluffy_missing', 'x') }}") == 'x'
+    env.fluffy_missing = 'y'
+    assert _render(local_env, "{{ env.get('fluffy_missing', 'x') }}") == 'y'
+
+
+def test_env_contains(local_env):
+    source = "{% if 'fluffy_flag' in env %}yes{% else %}no{% endif %}"
+    assert _render(local_env, source) == 'no'
+    env.fluffy_flag = True
+    assert _render(local_env, source) == 'yes'
+
+
+def test_env_items_are_not_cached(local_env):
+    source = ("{% for key, value in env.items() %}"
+              "{% if key == 'fluffy_item' %}{{ value }}{% endif %}"
+              "{% endfor %}")
+    env.fluffy_item = 'a'
+    assert _render(local_env, source) == 'a'
+    env.fluffy_item = 'b'
+    assert _render(local_env, source) == 'b'
+
+
+def test_rendering_follows_used_keys(local_env):
+    source = '{{ env.build }} {{ env["user"] }}'
+    assert _render(local_env, source) == 'test test'
+    env.build = 'other'
+    assert _render(local_env, source) == 'other test'
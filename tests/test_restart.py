@@ -0,0 +1,26 @@
+import os
+
+from fabric.api import env
+
+from fluffy.remote import restart_supervisord_services
+
+
+def test_rolling_restart_drains_web_process(local_env, monkeypatch):
+    calls = local_env.join('calls.log')
+    supervisorctl = local_env.join('bin', 'supervisorctl')
+    supervisorctl.write('#!/bin/sh\necho "$@" >> {}\n'.format(calls),
+                        ensure=True)
+    os.chmod(str(supervisorctl), 0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(local_env.join('bin'),
+                                              os.environ['PATH']))
+    env.update({
+        'supervisor_proc': 'web', 'celery_proc': 'celery',
+        'drain_command': 'echo drain >> {}'.format(calls),
+        'undrain_command': 'echo undrain >> {}'.format(calls),
+        'drain_grace': 0.1,
+    })
+
+    restart_supervisord_services(rolling=True)
+
+    assert calls.read().splitlines() == [
+        'drain', 'restart web', 'undrain', 'restart celery']
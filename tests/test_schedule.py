@@ -0,0 +1,62 @@
+import pytest
+
+from fabric.api import env
+
+from fluffy.operations import sudo
+from fluffy.schedule import Step, run_graph, _critical_path
+
+
+def _log(name, seconds=0):
+    sudo('sleep {}; echo {} >> {}'.format(seconds, name, env.schedule_log))
+
+
+def _provide(name, seconds=0):
+    _log(name, seconds)
+    env.artifact = 'provided by {}'.format(name)
+
+
+def _fail():
+    sudo('false')
+
+
+@pytest.fixture
+def schedule_log(local_env):
+    env.schedule_log = str(local_env.join('schedule.log'))
+    return local_env.join('schedule.log')
+
+
+def test_steps_start_after_their_requirements(schedule_log):
+    result = run_graph([
+        Step(_log, ('second',), requires=['artifact'], name='second'),
+        Step(_provide, ('first', 0.3), provides=['artifact'],
+             name='first'),
+        Step(_log, ('other',), name='other'),
+    ])
+
+    log = schedule_log.read().split()
+    assert log.index('first') < log.index('second')
+    assert log[0] == 'other'
+    assert env.artifact == 'provided by first'
+    assert result['critical_path'] == ['first', 'second']
+
+
+def test_no_steps_start_after_a_failure(schedule_log):
+    with pytest.raises(SystemExit):
+        run_graph([
+            Step(_fail, name='fail'),
+            Step(_log, ('independent',), name='independent'),
+            Step(_log, ('dependent',), requires=['fail'], name='dependent'),
+        ], max_workers=1)
+
+    assert not schedule_log.check()
+
+
+def test_critical_path_follows_longest_chain():
+    dependencies = {'a': set(), 'b': {'a'}, 'c': set(), 'd': {'b', 'c'}}
+    timings = {
+        'a': {'duration': 1, 'end': 1},
+        'b': {'duration': 1, 'end': 2},
+        'c': {'duration': 3, 'end': 3},
+        'd': {'duration': 1, 'end': 4},
+    }
+    assert _critical_path(dependencies, timings) == ['c', 'd']
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+from fabric.api import env
+
+from fluffy.search import deploy_solr
+
+
+def _stub(path, log):
+    path.write('#!/bin/sh\necho "$(basename $0) $*" >> {}\n'.format(log),
+               ensure=True)
+    os.chmod(str(path), 0o755)
+
+
+@pytest.fixture
+def solr(local_env, monkeypatch):
+    """
+    A build with Solr configuration, an installed Solr and stubs for
+    ``manage.py`` and ``service`` that log how they were called.
+    """
+    calls = local_env.join('calls.log')
+    code_dir = local_env.join('project', 'builds', 'test')
+    code_dir.join('deploy', 'solr', 'schema.xml').write('new', ensure=True)
+    _stub(code_dir.join('manage.py'), calls)
+    _stub(local_env.join('bin', 'service'), calls)
+    local_env.join('project', 'virtualenvs', 'test', 'bin',
+                   'activate').ensure()
+    solr_conf = local_env.join('solr', 'conf').ensure(dir=True)
+
+    monkeypatch.setenv('PATH', '{}:{}'.format(local_env.join('bin'),
+                                              os.environ['PATH']))
+    env.solr_dir = str(local_env.join('solr'))
+
+    def read_calls():
+        return calls.read().splitlines() if calls.check() else []
+    return solr_conf, read_calls
+
+
+def test_unchanged_configuration_updates_index(solr):
+    solr_conf, calls = solr
+    solr_conf.join('schema.xml').write('new')
+    env.solr_update_workers = 4
+
+    deploy_solr(age=24)
+
+    assert calls() == ['manage.py update_index --workers=4 --age=24']
+
+
+def test_changed_configuration_rebuilds_index(solr):
+    solr_conf, calls = solr
+    solr_conf.join('schema.xml').write('old')
+
+    deploy_solr()
+
+    assert solr_conf.join('schema.xml').read() == 'new'
+    assert calls() == ['service tomcat6 restart',
+                       'manage.py rebuild_index --noinput']
+
+
+def test_force_rebuilds_unchanged_configuration(solr):
+    solr_conf, calls = solr
+    solr_conf.join('schema.xml').write('new')
+
+    deploy_solr(force=True)
+
+    assert calls() == ['service tomcat6 restart',
+                       'manage.py rebuild_index --noinput']
@@ -0,0 +1,38 @@
+import os
+import tarfile
+
+from fabric.api import env
+
+from fluffy.remote import unpack
+
+
+def test_link_unchanged_links_identical_files(local_env):
+    builds = local_env.join('project', 'builds')
+    current = builds.join('test-old')
+    current.join('app.py').write('unchanged', ensure=True)
+    current.join('settings.py').write('old')
+    builds.join('test').mksymlinkto(current)
+
+    source = local_env.join('source', 'web')
+    source.join('app.py').write('unchanged', ensure=True)
+    source.join('settings.py').write('new')
+    archive = builds.join('build.tar.gz')
+    with tarfile.open(str(archive), 'w:gz') as tar:
+        tar.add(str(source), 'web')
+    # Leftovers of an interrupted unpack
+    builds.join('web', 'stale.py').write('', ensure=True)
+    builds.join('.staging-test-new', 'stale.py').write('', ensure=True)
+
+    env.update({'web_dir': 'web', 'build_dir': 'test-new', 'version': 'abc'})
+    unpack(str(archive), link_unchanged=True)
+
+    build = builds.join('test-new')
+    assert sorted(p.basename for p in build.listdir()) == [
+        'app.py', 'build-info', 'public', 'settings.py']
+    assert os.path.samefile(str(build.join('app.py')),
+                            str(current.join('app.py')))
+    assert not os.path.samefile(str(build.join('settings.py')),
+                                str(current.join('settings.py')))
+    assert build.join('settings.py').read() == 'new'
+    assert not builds.join('.staging-test-new').exists()
+    assert not archive.exists()
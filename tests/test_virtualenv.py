@@ -0,0 +1,26 @@
+import os
+
+from fabric.api import env
+
+from fluffy.remote import _switch_to_keyed_virtualenv
+
+
+def test_keyed_virtualenv_clones_shared_one_on_every_host(local_env,
+                                                          monkeypatch):
+    calls = local_env.join('clones.log')
+    clone = local_env.join('bin', 'virtualenv-clone')
+    clone.write('#!/bin/sh\necho "$1" >> {}\nmkdir -p "$2"\n'.format(calls),
+                ensure=True)
+    os.chmod(str(clone), 0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(local_env.join('bin'),
+                                              os.environ['PATH']))
+    local_env.join('project', 'builds', 'test', 'deploy', 'requirements',
+                   'test.txt').write('Django\n', ensure=True)
+    shared = env.virtualenv
+
+    for host in ('one', 'two'):
+        env.host_string = host
+        assert not _switch_to_keyed_virtualenv()
+
+    assert calls.read().splitlines() == [shared, shared]
+    assert env.virtualenv.startswith(shared + '-')